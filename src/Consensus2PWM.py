@@ -2,20 +2,118 @@
 from argparse import ArgumentParser
 from numpy import *
 from collections import OrderedDict
+import os
 
-def make_PWMs(consensus_filename, output_filename):
-    output = open(output_filename,'w')
+"""
+PWM rows added for each letter of an aligned k-mer, weighted by its z-score. Gaps ('.'),
+N and the padding past the end of a k-mer (byte 0) get the background row. Other bytes add
+nothing.
+"""
+_letter_weights = zeros((256,4))
+_letter_weights[[0,ord('.'),ord('N')]] = [0.23,0.27,0.27,0.23]
+_letter_weights[ord('A')] = [0.88,0.04,0.04,0.04]
+_letter_weights[ord('C')] = [0.04,0.88,0.04,0.04]
+_letter_weights[ord('G')] = [0.04,0.04,0.88,0.04]
+_letter_weights[ord('T')] = [0.04,0.04,0.04,0.88]
+
+_dna_ambig_dict = {
+    'A' : 'A',
+    'C' : 'C',
+    'G' : 'G',
+    'T' : 'T',
+    'AG' : 'R',
+    'CT' : 'Y',
+    'GT' : 'K',
+    'AC' : 'M',
+    'CG' : 'S',
+    'AT' : 'W',
+    'CGT' : 'B',
+    'AGT' : 'D',
+    'ACT' : 'H',
+    'ACG' : 'V',
+    'ACGT' : 'N'
+    }
+
+"""
+Consensus letter of each set of letters, indexed by a bit mask of A, C, G and T
+(A is the lowest bit). A column without any of them is N.
+"""
+_consensus_letters = array(['N']*16)
+for _letters, _consensus in _dna_ambig_dict.items():
+    _consensus_letters[sum([1 << 'ACGT'.index(l) for l in _letters])] = _consensus
+
+def make_PWMs(consensus_filename, output_filename, bundle_dirname=None):
     #zscores_dictionary = get_zscores_dictionary(counts_filename)
     #contains the lower alphabet k-mer and its z-score
     PWM_dict = get_PWM_dictionary(consensus_filename)
+    write_PWMs(output_filename, PWM_dict)
+    if bundle_dirname is not None:
+        write_seed_bundle(bundle_dirname, PWM_dict)
+
+def write_PWMs(output_filename, PWM_dict):
+    """ Writes the PWMs and consensus sequences of PWM_dict (see get_PWM_dictionary)
+    in the .wm format
+    """
+    output = open(output_filename,'w')
     keys = PWM_dict.keys()
     for key in keys:
         pwm = PWM_dict[key][0]
         consensus_sequence = PWM_dict[key][1]
         output.write('>'+key+"\t"+consensus_sequence+"\n")
-        output.write(array_str(pwm,precision=6).replace('[','').replace(']','').replace('0. ', '0.000000').replace('1. ', '1.000000').replace('0.\n', '0.000000\n').replace('1.\n', '1.000000\n').replace('\n  ','\n')[1:]+"\n\n")
+        output.write(format_PWM(pwm)+"\n")
     output.close()
 
+def format_PWM(pwm):
+    """ The rows of a PWM as text, with 6 decimals
+    """
+    return ("%.6f %.6f %.6f %.6f\n" * len(pwm)) % tuple(pwm.ravel())
+
+"""
+Binary seed bundle of the PWMs of a .wm file, for loading a seed by its index without
+reading the whole file. The bundle is a folder holding the rows of all PWMs stacked in one
+array (pwms.npy), where each PWM starts in it (offsets.npy) and the name and consensus
+sequence of each PWM (names.txt). The PWMs have the values written to the .wm file, so
+a seed is the same whether it is read from the bundle or from the .wm file.
+"""
+def write_seed_bundle(dirname, PWM_dict):
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    pwms = [fromstring(format_PWM(pwm), sep=' ').reshape(-1,4) for pwm, consensus in PWM_dict.values()]
+    offsets = concatenate(([0], cumsum([len(pwm) for pwm in pwms]))).astype(intp)
+    save(os.path.join(dirname, "pwms.npy"), concatenate(pwms) if pwms else zeros((0,4)))
+    save(os.path.join(dirname, "offsets.npy"), offsets)
+    output = open(os.path.join(dirname, "names.txt"), 'w')
+    for key, (pwm, consensus) in PWM_dict.items():
+        output.write(key+"\t"+consensus+"\n")
+    output.close()
+
+class SeedBundle:
+    """ The seeds of a bundle written by write_seed_bundle, as a sequence of (name, pwm)
+    tuples. The PWMs are memory-mapped, so only the seeds that are used are read. The
+    consensus sequences are in consensus.
+    """
+    def __init__(self, dirname):
+        self.offsets = load(os.path.join(dirname, "offsets.npy"))
+        if self.offsets[-1] > 0:
+            self.pwms = load(os.path.join(dirname, "pwms.npy"), mmap_mode='r')
+        else:#an empty file can not be memory-mapped
+            self.pwms = load(os.path.join(dirname, "pwms.npy"))
+        namesfile = open(os.path.join(dirname, "names.txt"))
+        parts_list = [line.split() for line in namesfile]
+        namesfile.close()
+        self.names = [p[0] for p in parts_list]
+        self.consensus = [p[1] for p in parts_list]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("seed index out of range")
+        return (self.names[i], array(self.pwms[self.offsets[i]:self.offsets[i+1]]))
+
 def get_PWM_dictionary(consensus_filename):
     PWM_dict = OrderedDict()
     consensusfile = open(consensus_filename,'r')
@@ -40,60 +138,25 @@ improved consensus sequence.
 """
 def get_PWM(lines):
     parts_list = [l.split() for l in lines]
-    width = max([len(p[0]) for p in parts_list])
-    consensus_parts = []
-    dna_ambig_dict = {
-        'A' : 'A',
-        'C' : 'C',
-        'G' : 'G',
-        'T' : 'T',
-        'AG' : 'R',
-        'CT' : 'Y',
-        'GT' : 'K',
-        'AC' : 'M',
-        'CG' : 'S',
-        'AT' : 'W',
-        'CGT' : 'B',
-        'AGT' : 'D',
-        'ACT' : 'H',
-        'ACG' : 'V',
-        'ACGT' : 'N'
-        }
-    for w in range(width):
-        consensus_parts.append(set())
-    pwm = zeros((width,4))
-    #making the pwm
-    for p in parts_list:
-        #zscore_key = p[1]
-        #zscore = zscores_dictionary[zscore_key]
-        zscore = float(p[4])
-        kmer = p[0] + '.'*(width - len(p[0]))
-        #iterate through the kmer letters and add to the pwm according to each letter
-        for k in range(width):
-            letter = kmer[k]
-            if letter =='.' or letter == 'N':
-                pwm[k] += zscore*array([0.23,0.27,0.27,0.23])
-            elif letter == 'A':
-                consensus_parts[k].add('A')
-                pwm[k] += zscore*array([0.88,0.04,0.04,0.04])
-            elif letter == 'C':
-                consensus_parts[k].add('C')
-                pwm[k] += zscore*array([0.04,0.88,0.04,0.04])
-            elif letter == 'G':
-                consensus_parts[k].add('G')
-                pwm[k] += zscore*array([0.04,0.04,0.88,0.04])
-            elif letter == 'T':
-                consensus_parts[k].add('T')
-                pwm[k] += zscore*array([0.04,0.04,0.04,0.88])
+    return get_aligned_PWM([p[0] for p in parts_list], [float(p[4]) for p in parts_list])
+
+"""
+Makes a PWM from aligned k-mers, each padded on the left with '.' to its
+place in the alignment, and their z-scores. Each count is weighted by the
+z-score for a k-mer. Function also returns an improved consensus sequence.
+"""
+def get_aligned_PWM(aligned_kmers, zscores):
+    width = max([len(kmer) for kmer in aligned_kmers])
+    #one row of letter codes per k-mer, padded with 0 bytes
+    codes = array(aligned_kmers, dtype='S'+str(width)).view(uint8).reshape(len(aligned_kmers), width)
+    #making the pwm. The rows are added up one k-mer at a time, in order
+    pwm = (array(zscores, dtype=float)[:,newaxis,newaxis]*_letter_weights[codes]).sum(axis=0)
     #normalize the pwm
     pwm = pwm/pwm.sum(axis=1)[:,newaxis]
-    consensus_sequence = ""
-    for consensus_part in consensus_parts:
-        consensus_part_sorted_list = sorted(consensus_part)
-        consensus_part_string = "".join(consensus_part_sorted_list)
-        if consensus_part_string == "":
-            consensus_part_string = "ACGT"
-        consensus_sequence += dna_ambig_dict[consensus_part_string]
+    masks = zeros(width, dtype=int)
+    for bit, letter in enumerate('ACGT'):
+        masks |= (codes == ord(letter)).any(axis=0) << bit
+    consensus_sequence = "".join(_consensus_letters[masks])
     return (pwm, consensus_sequence)
 
 def get_zscores_dictionary(counts_filename):    
@@ -115,10 +178,11 @@ def main():
     parser = ArgumentParser(description=description)
     parser.add_argument('consensusfile', metavar='c', help='Output from Clustering containing Kmer clusters')
     parser.add_argument('outputfile', metavar='o', help='Output file for results')
+    parser.add_argument("-binary", "--binary", dest="binary", help="Also write the PWMs to this folder as a binary seed bundle, which EXTREME.py can read instead of the output file", default=None)
     args = parser.parse_args()
     consensus_filename = args.consensusfile
     output_filename = args.outputfile
-    make_PWMs(consensus_filename, output_filename)
+    make_PWMs(consensus_filename, output_filename, args.binary)
 
 if __name__=='__main__':
     main()
\ No newline at end of file
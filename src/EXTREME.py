@@ -4,35 +4,37 @@ import random
 import copy
 import errno
 import sys
+import time
 import sequence
 from collections import deque
-from numpy import round_,mean,load,save,inf, sign, dot, diag, array, cumsum, sort, sum, searchsorted, newaxis, arange, sqrt, log2, log, power, floor, ceil, prod, zeros, ones, concatenate, argmin
+from numpy import round_,mean,load,save,inf, sign, dot, diag, array, cumsum, sort, sum, searchsorted, newaxis, arange, sqrt, log2, log, power, floor, ceil, prod, zeros, ones, concatenate, argmin, eye, maximum, where, bincount, exp, logaddexp, log1p, frombuffer, array_equal
 from itertools import chain
 
 """
-Equation 14 from the Bailey and Elkan paper. Calculates P(X|theta_motif). That is,
-the probability of the sequence given the motif model. It is defined as the product
-of the frequencies of the letter at each position.
+Equation 14 from the Bailey and Elkan paper, in log space. Calculates log P(X|theta_motif).
+That is, the log probability of the sequence given the motif model. It is defined as the sum
+of the log frequencies of the letter at each position. Working with sums of logs instead of
+products of frequencies avoids underflow for wide motifs.
 
 This is a modified version that uses the indicator matrix instead. Saves the trouble
 of calculating the indicator matrix at each step.
 
 Input:
 I, A boolean matrix. A representation of the sequence. Has dimension Wx4, the same as the PWM
-theta_motif, PWM. Columns in order of A, C, G, T. Each row must sum to 1. Number of rows must be same as X length
+log_theta_motif, log of the PWM. Columns in order of A, C, G, T. Number of rows must be same as X length
 
 Output:
-p, A double. P(X|theta_motif) 
+logp, A double. log P(X|theta_motif) 
 """
-def pI_motif(I, theta_motif):
-    ps = theta_motif[I]#some fancy indexing tricks. Gets me an array of the relevant frequencies
-    p = ps.prod()
-    return p
+def logpI_motif(I, log_theta_motif):
+    logps = log_theta_motif[I]#some fancy indexing tricks. Gets me an array of the relevant log frequencies
+    logp = logps.sum()
+    return logp
 
 """
-Equation 15 from the Bailey and Elkan paper. Calculates P(X|theta_background). That is,
-the probability of the sequence given the background model. It is defined as the product
-of the frequencies the letter at each position.
+Equation 15 from the Bailey and Elkan paper, in log space. Calculates log P(X|theta_background).
+That is, the log probability of the sequence given the background model. It is defined as the sum
+of the log frequencies the letter at each position.
 
 This is a modified version that uses the indicator matrix instead. Saves the trouble
 of calculating the indicator matrix at each step. Note also that theta_background
@@ -40,17 +42,44 @@ has been switched to theta_background_matrix, essentially a PWM for the backgrou
 
 Input:
 I, A boolean matrix. A representation of the sequence. Has dimension Wx4, the same as the PWM
-theta_background_matrix, Matrix of probabilities for each nucleotide, in order of A, C, G, T. 
-Each row must sum to 1. This is basically like the usual array, but the row vector is repeated W times
+log_theta_background_matrix, log of the matrix of probabilities for each nucleotide, in order of A, C, G, T. 
+This is basically like the usual array, but the row vector is repeated W times
 
 Output:
-p, A double. P(X|theta_background) 
+logp, A double. log P(X|theta_background) 
 """
-def pI_background(I, theta_background_matrix):
-    ps = theta_background_matrix[I]#some fancy indexing tricks. Gets me an array of the relevant frequencies
-    p = ps.prod()
-    return p
+def logpI_background(I, log_theta_background_matrix):
+    logps = log_theta_background_matrix[I]#some fancy indexing tricks. Gets me an array of the relevant log frequencies
+    logp = logps.sum()
+    return logp
 
+"""
+The logistic function, 1/(1+exp(-x)). Written with logaddexp so that it does not
+overflow for large negative x. Works on doubles and arrays.
+"""
+def logistic(x):
+    return exp(-logaddexp(0, -x))
+
+"""
+Equation 10 from the Bailey and Elkan paper, computed from the log-odds score of the
+sequence. Since Z0 = a/(a+b), where a = fudgefactor*P(X|theta_motif)*lambda_motif and
+b = P(X|theta_background)*(1-lambda_motif), Z0 is the logistic of log(a) - log(b),
+which is the log-odds score plus log(lambda_motif) - log(1-lambda_motif) plus log(fudgefactor).
+No probabilities are ever multiplied together.
+
+Input:
+V, a double or an array. The log-odds score(s), log P(X|theta_motif) - log P(X|theta_background)
+lambda_motif, a double. The fraction of motifs among the sequences.
+
+Output:
+Z0 - Expected value(s) of Z
+"""
+def Z0_logodds(V, lambda_motif, fudgefactor=1.0):
+    if lambda_motif <= 0:#no motif at all, same as a = 0 in the product form
+        return V*0.0
+    if lambda_motif >= 1:#no background at all, same as b = 0 in the product form
+        return V*0.0 + 1.0
+    return logistic(V + log(lambda_motif) - log1p(-lambda_motif) + log(fudgefactor))
 
 """
 Equation 10 from the Bailey and Elkan paper. The expectation of the Z value for the sequence X,
@@ -60,44 +89,59 @@ the background by taking 1 - Z0.
 
 
 This is a modified version that uses the indicator matrix instead. Saves the trouble
-of calculating the indicator matrix at each step. 
+of calculating the indicator matrix at each step. The motif and background models come in
+as the log-odds matrix spec = log(theta_motif/theta_background_matrix), which the online
+EM precomputes once per update.
 
 Input:
 I, indicator matrix. Represents a sequence.
-theta_motif, a matrix. The PWM of the motif.
-theta_background_matrix, a matrix. Essentially a PWM of the background model.
+spec, a matrix. The log-odds matrix of the motif against the background.
 lambda_motif, a double. The fraction of motifs among the sequences.
 
 Output:
 Z0 - Expected value of Z for the the indicator matrix I. Returns 0 if I is None
 """
-def Z0_I(I,theta_motif, theta_background_matrix,lambda_motif, fudgefactor=1.0):
+def Z0_I(I, spec, lambda_motif, fudgefactor=1.0):
     if I is None:
         return 0
-    a = fudgefactor*pI_motif(I,theta_motif)*lambda_motif#saves a calculation
-    b = pI_background(I,theta_background_matrix)*(1-lambda_motif)#saves another calculation
-    Z0 = a/(a + b)
+    Z0 = Z0_logodds(spec[I].sum(), lambda_motif, fudgefactor)
     return Z0
 
 """
-Function that accepts a string, X, and returns an indicator matrix, I. Representing
-each sequence as an indicator matrix will save time and memory.
+Block version of Z0_I. Computes the expected Z values of many windows at once,
+on one strand, as a single array operation.
 
 Input:
-X, a string. The sequence to be converted to an indicator matrix
+Xb, a matrix of letter codes. Each row is a window of width W (from PackedSequences.windows)
+spec, a matrix. The log-odds matrix of the motif against the background.
+lambda_motif, a double. The fraction of motifs among the sequences.
 
 Output:
-I, a boolean matrix. The indicator matrix. Has dimensions Wx4. Each row is a position along the string.
-Each column represents a nucleotide, in alphabetical order. If X contains a deleted base pair,
-the returned indicator matrix will be a None.
+Z0 - array of the expected values of Z, one for each row of Xb
 """
-def sequenceToI(X):
-    if 'N' in X:
-        return None
-    l = array(list(X))#convert the string to an array of characters
-    d = array(['A','C','G','T'])#the 4 nucleotides
-    I = l[:,newaxis] == d#construct the matrix
-    return I
+def Z0_block(Xb, spec, lambda_motif, fudgefactor=1.0):
+    V = spec[arange(Xb.shape[1]),Xb].sum(axis=1)#column sums of the log-odds matrix
+    Z0 = Z0_logodds(V, lambda_motif, fudgefactor)
+    return Z0
+
+#indicator rows for the letter codes of sequence.PackedSequences. The N code (4) gets an all False row
+_indicator_table = concatenate((eye(4,dtype=bool),zeros((1,4),dtype=bool)))
+
+"""
+Function that accepts the letter codes of a window from a sequence.PackedSequences
+object and returns its indicator matrix. This is what replaces the precomputed lists
+of indicator matrices. Only one indicator matrix exists at a time, so memory stays
+proportional to the number of base pairs.
+
+Input:
+x, a uint8 array of length W. Letter codes A=0, C=1, G=2, T=3
+
+Output:
+I, a boolean matrix. The indicator matrix. Has dimensions Wx4. Each row is a position in the window,
+each column a nucleotide in alphabetical order. N positions get an all False row
+"""
+def codesToI(x):
+    return _indicator_table[x]
 
 """
 Computes a term in the summation, equation 11.
@@ -115,22 +159,24 @@ Output:
 elogL - a summation term of equation 11
 """
 def expLog_I(I,theta_motif, theta_background_matrix,lambda_motif):
-    a = pI_motif(I,theta_motif)*lambda_motif#saves a calculation
-    b = pI_background(I,theta_background_matrix)*(1-lambda_motif)#saves another calculation
-    Z0 = a/(a + b)
-    elogL = Z0*log(a) + (1-Z0)*log(b)
+    loga = logpI_motif(I,log(theta_motif)) + log(lambda_motif)#saves a calculation
+    logb = logpI_background(I,log(theta_background_matrix)) + log(1-lambda_motif)#saves another calculation
+    Z0 = logistic(loga - logb)
+    elogL = Z0*loga + (1-Z0)*logb
     return elogL
 
 """
-Calculates the expected log likelihood. Accepts the list of indicator matrices I, the current motif
-frequency lambda_motif, and both PWMs. Returns the expected log likelihood.
+Calculates the expected log likelihood. Accepts the windows of the packed dataset and the valid
+window starts, the current motif frequency lambda_motif, and both PWMs. Returns the expected log likelihood.
+
+The terms are the same as expLog_I, but all windows are done at once in log space with scan_windows.
 
-Note that this uses the indicator matrices only in order to save time converting.
 This function is only meant for debugging purposes, since in practice calculating the expected log likelihood
 defeats the purpose of an online algorithm.
 
 Input:
-I, a list of indicator matrices. This might get confusing with I being a list here and a matrix elsewhere.
+X, strided windows of the packed dataset (from PackedSequences.windows)
+starts, array of valid window start positions (from PackedSequences.validStarts)
 theta_motif, a matrix. The PWM of the motif.
 theta_background_matrix, a matrix. Essentially a PWM of the background model.
 lambda_motif, a double. The fraction of motifs among the sequences.
@@ -140,11 +186,11 @@ expected_LogLikelihood, the expected log likelihood
 
 7/5/13: Work on this next
 """
-def expected_LogLikelihood(I, theta_motif, theta_background_matrix, lambda_motif):
-    expected_LogLikelihood = 0
-    for Ii in I:
-        for Iij in Ii:
-            expected_LogLikelihood = expected_LogLikelihood + expLog_I(Iij,theta_motif, theta_background_matrix,lambda_motif)
+def expected_LogLikelihood(X, starts, theta_motif, theta_background_matrix, lambda_motif):
+    loga = scan_windows(log(theta_motif), X, starts, False)[0] + log(lambda_motif)
+    logb = scan_windows(log(theta_background_matrix), X, starts, False)[0] + log(1-lambda_motif)
+    Z0 = logistic(loga - logb)
+    expected_LogLikelihood = (Z0*loga + (1-Z0)*logb).sum()
     return expected_LogLikelihood
 
 """
@@ -162,23 +208,6 @@ def dist(u,v):
     w = power(w,2)
     return sqrt(w.sum())
 
-"""
-Function that returns a list of subsequences, X,
-of width W, from the dataset of sequences, Y.
-It is effectively a ragged array
-
-Input:
-Y, dataset of sequences. A pygr SequenceFileDB object 
-W, motif width
-
-Notes:
-For the Online version, this may need to be removed for RAM purposes.
-"""
-def getSubsequences(Y, W):
-    return [[y[k:k+W] for k in xrange(len(y)-W+1)] for y in Y]
-
-
-
 """
 Calculates and returns the symmetrized KL Divergence between two PFMs.
 """
@@ -186,60 +215,47 @@ def KLD(x,y):
     Z = 0.5*(sum(x*log(x/y)) + sum(y*log(y/x)))
     return Z
 
-def get_probs(seqs, alphabet_string):
-    """ Get the observed probabilities of the letters in a set
-    of sequences.  Ambiguous characters are ignored.
-    Uses an "add-one" prior. From dreme.py by T. Bailey"""
-
-    freqs = {}
-    # initialize with add-one count
-    for char in alphabet_string:
-        freqs[char] = 1
-    # get the frequencies of DNA letters in the sequences
-    for seq in seqs:
-        for char in seq:
-            if freqs.has_key(char):
-                freqs[char] += 1
-            else:
-                freqs[char] = 0         # ambiguous letter
-    # get the total number of non-ambiguous letters
-    n = 0.0
-    for char in alphabet_string:
-        n += freqs[char]
-    # normalize the probabilities
+"""
+Gets the observed probabilities of the letters in a sequence.PackedSequences object.
+Ambiguous letters (N) are ignored. The letters are counted with a single bincount over
+the letter codes. Uses an "add-one" prior, like get_probs in dreme.py by T. Bailey.
+"""
+def get_packed_probs(seqs, alphabet_string):
+    counts = seqs.getLetterCounts()[:len(alphabet_string)] + 1.0
+    counts = counts/counts.sum()
     probs = {}
-    for char in alphabet_string:
-        probs[char] = freqs[char]/n
-
+    for i, char in enumerate(alphabet_string):
+        probs[char] = counts[i]
     return probs
 
 
-
 """
 The online EM algorithm. 
 
 Input:
-Is, list of lists of indicator matrices. dataset of sequences
-seqindpairs, list of tuples of valid sequence and subsequence indices to use
+X, strided windows of the packed dataset (from PackedSequences.windows)
+seqindpairs, array of valid window start positions to use, in the order they are visited
 theta_motif, motif PWM matrix guess
 theta_background_matrix, background PWM matrix guess
 lambda_motif, motif frequency guess
 smoothing, whether to smooth (default: False)
 revcomp, whether to use both strands (default: True)
 B, pseudo-counts parameter (default: 0.001)
+batchsize, number of windows per update. Values above 1 use Online_EM_batch (default: 1)
 
 Output:
 theta_motif, motif PWM matrix
 theta_background_matrix, background PWM matrix
 lambda_motif, motif frequency
 """
-def Online_EM(Is, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, minsites, maxsites, initialstep=0.05, B=0.0001, smoothing=False, revcomp=True):
+def Online_EM(X, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, minsites, maxsites, initialstep=0.05, B=0.0001, smoothing=False, revcomp=True, batchsize=1):
+    if batchsize > 1:
+        return Online_EM_batch(X, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, initialstep, B, revcomp, batchsize)
     W = theta_motif.shape[0]#get the length of the motif
     s1_1 = lambda_motif#the expected number of occurrences of the motif
     s1_2 = theta_motif#the matrix holding the expected number of times a letter appears in each position, motif
     s2_2 = theta_background_matrix#the matrix holding the expected number of times a letter appears in each position, background
     n = 0#the counter
-    N = len(Is)#number of sequences
     pwms = list()
     backgrounds = list()
     expectations = list()
@@ -254,17 +270,16 @@ def Online_EM(Is, seqindpairs, theta_motif, theta_background_matrix, lambda_moti
     print "Initial step size of " + str(g0)
     print "Running Online EM algorithm..."
     pwm_deque = deque(maxlen=100)
+    spec = log(theta_motif) - log(theta_background_matrix)#log-odds matrix used by the E-step
     for ps in range(5):
-        for seqindpair in seqindpairs:#iterate through each sequence index and start pair
-            seqind = seqindpair[0]
-            start = seqindpair[1]
+        for start in seqindpairs:#iterate through each valid window start
             step = g0*pow(n+1,g1)#the online step size. For OLO6a
-            I = Is[seqind][start]#grab the current indicator matrix
-            Z = Z0_I(I,theta_motif, theta_background_matrix,lambda_motif, fudgefactor)#perhaps implement RC better here?
+            I = codesToI(X[start])#grab the current indicator matrix
+            Z = Z0_I(I, spec, lambda_motif, fudgefactor)#perhaps implement RC better here?
             this_strand = True
             if revcomp:#if the user wants reverse complements
                 Ir = I_rc(I)
-                Zr = Z0_I(Ir,theta_motif, theta_background_matrix,lambda_motif, fudgefactor)
+                Zr = Z0_I(Ir, spec, lambda_motif, fudgefactor)
                 if Zr > Z:
                     Z = Zr
                     I = Ir
@@ -286,13 +301,14 @@ def Online_EM(Is, seqindpairs, theta_motif, theta_background_matrix, lambda_moti
             theta_background = theta_background/theta_background.sum()#divide by the total counts to normalize to 1
             theta_background = array([theta_background])#prepare background for repeat
             theta_background_matrix = theta_background.repeat(W,axis=0)
+            spec = log(theta_motif) - log(theta_background_matrix)
 
             #update the counter
             n = n + 1
             pwm_deque.append(theta_motif)
             #print n
             #the expected log likelihood, the objective function, based on current parameters
-            #expectations.append(expected_LogLikelihood(Is, theta_motif, theta_background_matrix, lambda_motif))#add the expectation of the initial guess
+            #expectations.append(expected_LogLikelihood(X, seqindpairs, theta_motif, theta_background_matrix, lambda_motif))#add the expectation of the initial guess
         print "KLD:",KLD(pwm_deque[0],pwm_deque[-1])
         if KLD(pwm_deque[0],pwm_deque[-1]) < 1e-6:
             print "KLD threshold met on pass",ps+1
@@ -306,22 +322,228 @@ def Online_EM(Is, seqindpairs, theta_motif, theta_background_matrix, lambda_moti
                 #break
     return theta_motif, theta_background_matrix, lambda_motif
 
+"""
+Mini-batch version of the online EM algorithm. The E-step is done for a block of
+batchsize windows at once, on both strands, and the sufficient statistics s1_1,
+s1_2 and s2_2 are updated once per block with the block averages.
 
+The step size schedule is the same as in Online_EM and still counts windows, not
+blocks. A block gets the weight the sequential updates of its windows would have had
+together, 1 - prod(1 - step) over the steps of its windows, so a pass over the data
+moves the parameters about as far as a pass of Online_EM. The KLD convergence check
+also looks back over the same number of windows (about 100).
+
+Input:
+X, strided windows of the packed dataset (from PackedSequences.windows)
+seqindpairs, array of valid window start positions to use, in the order they are visited
+theta_motif, motif PWM matrix guess
+theta_background_matrix, background PWM matrix guess
+lambda_motif, motif frequency guess
+fudgefactor, bias factor for the motif component
+initialstep, the initial step size (default: 0.05)
+B, pseudo-counts parameter (default: 0.001)
+revcomp, whether to use both strands (default: True)
+batchsize, number of windows per update (default: 1000)
+
+Output:
+theta_motif, motif PWM matrix
+theta_background_matrix, background PWM matrix
+lambda_motif, motif frequency
+"""
+def Online_EM_batch(X, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, initialstep=0.05, B=0.0001, revcomp=True, batchsize=1000):
+    W = theta_motif.shape[0]#get the length of the motif
+    s1_1 = lambda_motif#the expected number of occurrences of the motif
+    s1_2 = theta_motif#the matrix holding the expected number of times a letter appears in each position, motif
+    s2_2 = theta_background_matrix#the matrix holding the expected number of times a letter appears in each position, background
+    n = 0#the counter, in windows
+    mu = theta_background_matrix#the first background matrix is the average frequencies in the negative set
+    Bmu = B*mu#the priors to be added each step
+    g0 = max(initialstep,lambda_motif*10)
+    g1 = -0.6
+    cols = arange(W)*4#offset of each row when the counts are flattened
+    print "Initial step size of " + str(g0)
+    print "Running Online EM algorithm with batches of " + str(batchsize) + " windows..."
+    pwm_deque = deque(maxlen=max(2,100//batchsize))
+    for ps in range(5):
+        passtime = time.time()
+        for i in xrange(0, len(seqindpairs), batchsize):
+            block = seqindpairs[i:i+batchsize]
+            m = len(block)
+            steps = g0*power(arange(n+1,n+m+1,dtype=float),g1)#the online step sizes of the windows in this block
+            step = 1 - (1 - steps).prod()
+            Xb = X[block]#letter codes of the windows, m x W
+            spec = log(theta_motif) - log(theta_background_matrix)#log-odds matrix, once per block
+            Z = Z0_block(Xb, spec, lambda_motif, fudgefactor)
+            if revcomp:#if the user wants reverse complements
+                Xr = 3 - Xb[:,::-1]#letter codes of the reverse complements
+                Zr = Z0_block(Xr, spec, lambda_motif, fudgefactor)
+                this_strand = Zr <= Z#opposite strand strong, use reverse complement
+                Z = where(this_strand, Z, Zr)
+                Xb = where(this_strand[:,newaxis], Xb, Xr)
+            #block averages of the sufficient statistics. Letter counts are weighted by Z
+            cells = (cols + Xb).ravel()
+            counts1 = bincount(cells, weights=Z.repeat(W), minlength=4*W).reshape((W,4))
+            counts2 = bincount(cells, weights=(1-Z).repeat(W), minlength=4*W).reshape((W,4))
+            ds1_1 = Z.mean()
+            ds1_2 = (counts1 + Z.sum()*Bmu)/m
+            ds2_2 = (counts2 + (m - Z.sum())*Bmu)/m
+            s1_1 = s1_1 + step*(ds1_1 - s1_1)
+            s1_2 = s1_2 + step*(ds1_2 - s1_2)
+            s2_2 = s2_2 + step*(ds2_2 - s2_2)
+            #M-step
+            lambda_motif = s1_1
+            theta_motif = s1_2/s1_2.sum(axis=1)[:,newaxis]#ensures each row has sum 1, for prob
+
+            theta_background = s2_2.sum(axis = 0)#collapse the expected background counts into a single array
+            theta_background = theta_background/theta_background.sum()#divide by the total counts to normalize to 1
+            theta_background = array([theta_background])#prepare background for repeat
+            theta_background_matrix = theta_background.repeat(W,axis=0)
+
+            #update the counter
+            n = n + m
+            pwm_deque.append(theta_motif)
+        print "Pass",ps+1,"took",time.time()-passtime,"seconds"
+        print "KLD:",KLD(pwm_deque[0],pwm_deque[-1])
+        if KLD(pwm_deque[0],pwm_deque[-1]) < 1e-6:
+            print "KLD threshold met on pass",ps+1
+            break
+        else:
+            print "KLD threshold not met. Doing another pass"
+            g1 = (g1-1)/2
+    return theta_motif, theta_background_matrix, lambda_motif
+
+
+
+"""
+One try of the extreme algorithm: runs the online EM from the seed with a given fudge factor
+and counts the discrete motif sites of the result.
+
+Input:
+X, strided windows of the packed dataset (from PackedSequences.windows)
+seqindpairs, array of valid window start positions, in the order they are visited
+DQ, the PFM of the initial guess
+theta_background, the background frequencies, a 1x4 matrix
+lambda_motif, motif frequency guess
+fudgefactor, the bias factor to try
+minsites, the minimium number of sites
+maxsites, the maximum number of sites
+initialstep, the initial step size for the online EM
+batchsize, number of windows per online EM update
+
+Output:
+theta_motif, motif PWM matrix
+theta_background_matrix, background PWM matrix
+lambda_motif, motif frequency
+nsites_dis, number of discrete motif sites
+"""
+def run_try(X, seqindpairs, DQ, theta_background, lambda_motif, fudgefactor, minsites, maxsites, initialstep=0.05, batchsize=1):
+    theta_motif = DQ
+    theta_background_matrix = theta_background.repeat(theta_motif.shape[0],axis=0)#the initial guess for background is uniform distribution
+    theta_motif, theta_background_matrix, lambda_motif = Online_EM(X, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, minsites, maxsites, initialstep, batchsize=batchsize)
+    print 'Finding number of motif sites'
+    if lambda_motif < 1e-9:
+        nsites_dis = 0
+    else:
+        nsites_dis = get_nsites_dis(theta_motif, theta_background_matrix, lambda_motif, X, seqindpairs)
+    print 'Found ' + str(nsites_dis) + ' sites'
+    return theta_motif, theta_background_matrix, lambda_motif, nsites_dis
+
+#data for the worker processes of the parallel fudge factor search. It is set before the
+#pool is created, so the forked workers all see the same dataset and visiting order
+_fudge_run = {}
+
+"""
+Worker for the parallel fudge factor search. Runs one try with the dataset set up by extreme.
+
+Input:
+fudgefactor, the bias factor to try
+
+Output:
+Same as run_try
+"""
+def run_fudge_try(fudgefactor):
+    X, seqindpairs, DQ, theta_background, lambda_motif, minsites, maxsites, initialstep, batchsize = _fudge_run['data']
+    return run_try(X, seqindpairs, DQ, theta_background, lambda_motif, fudgefactor, minsites, maxsites, initialstep, batchsize)
+
+#E-value engine of the last dataset and background, see get_evalue_engine
+_evalue_engine = {}
+
+"""
+Gets a MEME E-value engine for a dataset and background. The engine is kept and reused for
+as long as the sequence lengths and the background stay the same, which they do for all
+tries of a seed and all seeds of a run.
+
+Input:
+me, the MEME Cython wrapper module
+Y, the dataset of sequences (only the lengths are used)
+theta_background, background probabilities
+
+Output:
+the engine (me.EvalueEngine)
+"""
+def get_evalue_engine(me, Y, theta_background):
+    lengths = Y.getSeqLens()
+    engine = _evalue_engine.get('engine')
+    if engine is None or not array_equal(_evalue_engine['lengths'], lengths) or not array_equal(engine.get_background(), theta_background):
+        engine = me.EvalueEngine(lengths, theta_background)
+        _evalue_engine['engine'] = engine
+        _evalue_engine['lengths'] = lengths
+    return engine
+
+"""
+Calculates the log E-values of several motifs at once with the MEME Cython wrapper. They are
+computed in one call that does not hold the GIL, each with its own background, split over
+threads threads. If the wrapper is not installed, the E-values are set to the largest possible value.
+
+Input:
+theta_motifs, list of motif PWM matrices
+theta_background_matrices, list of the background PWM matrices of the motifs
+Y, the dataset of sequences (only the lengths are used)
+nsites_dis, list of the numbers of discrete motif sites
+BIGLOG, the largest possible log E-value
+threads, number of threads (default: 1)
+
+Output:
+logevs, list of the log E-values
+"""
+def calc_logevs(theta_motifs, theta_background_matrices, Y, nsites_dis, BIGLOG, threads=1):
+    try:
+        import meme as me
+        backgrounds = [theta_background_matrix[0] for theta_background_matrix in theta_background_matrices]
+        engine = get_evalue_engine(me, Y, backgrounds[0])
+        print 'Calculating',len(theta_motifs),'log E-values'
+        logevs = engine.logevs(theta_motifs, nsites_dis, backgrounds, threads).tolist()
+        for logev in logevs:
+            print 'Log E-value: ' + str(logev)
+    except ImportError:
+        print "You did not install the MEME Cython wrapper, so the E-values will be set to the largest possible value"
+        logevs = [BIGLOG]*len(theta_motifs)
+    return logevs
 
 """
 A modified version of the extreme algorithm. It uses PFMs from a database such as JASPAR
 or the UW ENCODE group, and the predicted number of sites, as seeds.
 
 Input:
-Y, list of strings. dataset of sequences
+Y, sequence.PackedSequences. dataset of sequences
+neg_seqs, sequence.PackedSequences. negative sequences, only used for the background and erasing.
+If None, the background comes from the letter frequencies of Y (the order 0 part of its Markov model)
 minsites, the minimium number of sites
 maxsites, the maximum number of sites. If 0, it is automatically changed to 5 times the number of predicted sites
 pwm_guess, the PFM of the initial guess
 tries, number of different "fudge factors"/bias factors to try before giving up
+batchsize, number of windows per online EM update. 1 is the original online EM
+erase, whether to erase the discovered motif from Y and neg_seqs. If False, the sites are only
+counted, so read-only (shared) sequences can be used
+fudgeprocs, number of fudge factors tried at the same time, each on its own process. Instead of
+bisecting one fudge factor at a time, each round tries fudgeprocs fudge factors spread over the
+current bracket and narrows the bracket with all of their site counts
+threads, number of threads for the E-values of the tries with an acceptable number of sites in
+a round of fudgeprocs tries. The motif is the one among them with the lowest E-value
 Output:
-fractions
+fractions, or None if no try had an acceptable number of sites
 """
-def extreme(Y,neg_seqs,minsites,maxsites,pwm_guess,initialstep=0.05,tries=15,revcomp=True):
+def extreme(Y,neg_seqs,minsites,maxsites,pwm_guess,initialstep=0.05,tries=15,revcomp=True,batchsize=1,erase=True,fudgeprocs=1,threads=1):
     #6/28/13, check with initial conditions matching solution
     #p = Pool(64)
     #s=p.map(functools.partial(f,y=Y),range(64))
@@ -340,7 +562,7 @@ def extreme(Y,neg_seqs,minsites,maxsites,pwm_guess,initialstep=0.05,tries=15,rev
     all_theta_motifs = list()
     all_theta_background_matrices = list()
     all_logevs = list()
-    dprobs = get_probs(neg_seqs, _dna_alphabet)
+    dprobs = get_packed_probs(Y if neg_seqs is None else neg_seqs, _dna_alphabet)
     #generate first order Markov background based on nucleotide frequencies
     print 'Getting background model'
     theta_background = array([[dprobs['A'], dprobs['C'], dprobs['G'], dprobs['T']]])
@@ -357,86 +579,123 @@ def extreme(Y,neg_seqs,minsites,maxsites,pwm_guess,initialstep=0.05,tries=15,rev
     #print 'Using starting point from DREME PWM generation...'
     #n = sum([max(0,len(y) - W + 1) for y in Y])#gets number of subsequences
     print 'Getting subsequences'
-    X = getSubsequences(Y,W)#this step may need to be removed for Online to save RAM
-    #subsequences are grouped by sequences for normalization purposes
-    print 'Getting indicator matrices'
-    Is = [[sequenceToI(xij) for xij in xi] for xi in X]#list of indicator matrices for this specific W, same dimensions as X    
+    X = Y.windows(W)#strided views into the packed sequences, no copies
+    #Valid subsequence start positions to search. 
+    #subsequences with deleted base pairs or crossing two sequences are left out
+    seqindpairs = Y.validStarts(W)
     DR = theta_background.repeat(DQ.shape[0],axis=0)#the initial guess for background is uniform distribution
     print "Scanning sequence with current PWM guess"
-    pos = guess_positive_sites(DQ, DR, Is)
+    pos = guess_positive_sites(DQ, DR, X, seqindpairs)
     print "Guessing",pos,"sites"
     #print "Found",pos,"consensus sequence matches in the positive sequences"
     #print "Found",neg,"consensus sequence matches in the negative sequences"
     if maxsites == 0:
         maxsites = pos*5
         print "Maximum number of sites not specified, so setting it to",maxsites
-    #Valid sequence and subsequence index combinations to search. 
-    #subsequences with deleted base pairs will yield a None indicator matrix, which will be ignored in this list
-    seqindpairs = [[(seqind,subseqind) for subseqind in xrange(len(Is[seqind])) if Is[seqind][subseqind] is not None] for seqind in xrange(len(Is))]
-    seqindpairs = list(chain(*seqindpairs))
     n = len(seqindpairs)#total number of subsequences
     random.shuffle(seqindpairs)
     #The bounds for the fudge factor
     a = 0.0
     b = 1.0
     c = 1.0
-    for t in range(tries):
-        print 'Try ' + str(t + 1)
-        print 'Using a fudge factor of ' + str(b)
-        fudgefactor = b
-        theta_motif = DQ
-        lambda_motif = 1.0*pos/n#guess twice the number regular expression matches
-        theta_background_matrix = theta_background.repeat(theta_motif.shape[0],axis=0)#the initial guess for background is uniform distribution
-        theta_motif, theta_background_matrix, lambda_motif = Online_EM(Is, seqindpairs, theta_motif, theta_background_matrix, lambda_motif, fudgefactor, minsites, maxsites, initialstep)
-        print 'Finding number of motif sites'
-        if lambda_motif < 1e-9:
-            nsites_dis = 0
-        else:
-            nsites_dis = get_nsites_dis(theta_motif, theta_background_matrix, lambda_motif, Is)
-        print 'Found ' + str(nsites_dis) + ' sites'
-        #if there are too many discovered sites, something is wrong, so assign a high E-value
-        shouldIBreak = False
-        if nsites_dis > maxsites:#for now, assume problem if more than 10 instances per sequence
-            print 'Too many sites found. Setting log E-value to max value. Lowering fudge factor and reshuffling'
-            logev = BIGLOG
-            c = b
-            b = mean([a,b])
-            random.shuffle(seqindpairs)
-        elif nsites_dis < minsites:
-            print 'Not enough sites found. Setting log E-value to max value. Raising fudge factor and reshuffling'
-            logev = BIGLOG
-            a = b
-            b = mean([b,c])
+    if fudgeprocs > 1:
+        from multiprocessing import Pool
+        from multiprocessing.sharedctypes import RawArray
+        from ctypes import c_byte
+        #the visiting order goes into shared memory, so that reshuffling it here is seen by the workers
+        shared = frombuffer(RawArray(c_byte, max(1, seqindpairs.nbytes)), dtype=seqindpairs.dtype)[:n]
+        shared[:] = seqindpairs
+        seqindpairs = shared
+        _fudge_run['data'] = (X, seqindpairs, DQ, theta_background, 1.0*pos/n, minsites, maxsites, initialstep, batchsize)
+        pool = Pool(fudgeprocs)
+        t = 0
+        while t < tries:
+            k = min(fudgeprocs, tries - t)
+            if t == 0:#the first round includes the upper bound, like the first sequential try
+                fudgefactors = [c] + [a + (c-a)*j/k for j in range(1,k)]
+            else:#spread the candidates evenly inside the bracket
+                fudgefactors = [a + (c-a)*(j+1)/(k+1) for j in range(k)]
+            print 'Tries ' + str(t + 1) + ' to ' + str(t + k)
+            print 'Using fudge factors of ' + ', '.join([str(f) for f in fudgefactors])
+            results = pool.map(run_fudge_try, fudgefactors, chunksize=1)
+            t = t + k
+            shouldIBreak = False
+            too_few = list()
+            #the E-values of all acceptable motifs of the round are computed together. The others can
+            #never be picked, and the LLR table of a motif with many sites is slow to build
+            accepted = [j for j, result in enumerate(results) if minsites <= result[3] <= maxsites]
+            round_logevs = [BIGLOG]*len(results)
+            if accepted:
+                accepted_logevs = calc_logevs([results[j][0] for j in accepted], [results[j][1] for j in accepted], Y, [results[j][3] for j in accepted], BIGLOG, threads)
+                for j, logev in zip(accepted, accepted_logevs):
+                    round_logevs[j] = logev
+            for fudgefactor, (theta_motif, theta_background_matrix, lambda_motif, nsites_dis), logev in zip(fudgefactors, results, round_logevs):
+                print 'Fudge factor ' + str(fudgefactor) + ' found ' + str(nsites_dis) + ' sites'
+                if nsites_dis > maxsites:
+                    c = min(c, fudgefactor)
+                elif nsites_dis < minsites:
+                    too_few.append(fudgefactor)
+                else:
+                    shouldIBreak = True
+                    print 'Motif has an acceptable number of sites, with log E-value ' + str(logev)
+                    logevs.append(logev)
+                    lambda_motifs.append(lambda_motif)
+                    theta_motifs.append(theta_motif)
+                    theta_background_matrices.append(theta_background_matrix)
+                #save everything
+                all_logevs.append(logev)
+                all_lambda_motifs.append(lambda_motif)
+                all_theta_motifs.append(theta_motif)
+                all_theta_background_matrices.append(theta_background_matrix)
+            if shouldIBreak:
+                break
+            #the new bracket is between the largest fudge factor with too few sites and the smallest with too many
+            a = max([a] + [f for f in too_few if f < c])
+            print 'No fudge factor had an acceptable number of sites. Narrowing the search to ' + str(a) + ' - ' + str(c) + ' and reshuffling'
             random.shuffle(seqindpairs)
-        else:
-            shouldIBreak = True
-            print 'Motif has an acceptable number of sites'    
-            try:
-                import meme as me
-                mm = me.MEME(theta_motif, theta_background_matrix[0], lambda_motif, Y, nsites_dis)
-                print 'Calculating log E-value'
-                mm.calc_ent()
-                logev = mm.get_logev()
-                print 'Log E-value: ' + str(logev)
-            except ImportError:
-                print "You did not install the MEME Cython wrapper, so the E-value will be set to the largest possible value"
+        pool.close()
+        pool.join()
+    else:
+        for t in range(tries):
+            print 'Try ' + str(t + 1)
+            print 'Using a fudge factor of ' + str(b)
+            fudgefactor = b
+            lambda_motif = 1.0*pos/n#guess twice the number regular expression matches
+            theta_motif, theta_background_matrix, lambda_motif, nsites_dis = run_try(X, seqindpairs, DQ, theta_background, lambda_motif, fudgefactor, minsites, maxsites, initialstep, batchsize)
+            #if there are too many discovered sites, something is wrong, so assign a high E-value
+            shouldIBreak = False
+            if nsites_dis > maxsites:#for now, assume problem if more than 10 instances per sequence
+                print 'Too many sites found. Setting log E-value to max value. Lowering fudge factor and reshuffling'
                 logev = BIGLOG
-            logevs.append(logev)
-            lambda_motifs.append(lambda_motif)
-            theta_motifs.append(theta_motif)
-            theta_background_matrices.append(theta_background_matrix)
-        #save everything
-        all_logevs.append(logev)
-        all_lambda_motifs.append(lambda_motif)
-        all_theta_motifs.append(theta_motif)
-        all_theta_background_matrices.append(theta_background_matrix)
-        if shouldIBreak:
-            break
+                c = b
+                b = mean([a,b])
+                random.shuffle(seqindpairs)
+            elif nsites_dis < minsites:
+                print 'Not enough sites found. Setting log E-value to max value. Raising fudge factor and reshuffling'
+                logev = BIGLOG
+                a = b
+                b = mean([b,c])
+                random.shuffle(seqindpairs)
+            else:
+                shouldIBreak = True
+                print 'Motif has an acceptable number of sites'    
+                logev = calc_logevs([theta_motif], [theta_background_matrix], Y, [nsites_dis], BIGLOG)[0]
+                logevs.append(logev)
+                lambda_motifs.append(lambda_motif)
+                theta_motifs.append(theta_motif)
+                theta_background_matrices.append(theta_background_matrix)
+            #save everything
+            all_logevs.append(logev)
+            all_lambda_motifs.append(lambda_motif)
+            all_theta_motifs.append(theta_motif)
+            all_theta_background_matrices.append(theta_background_matrix)
+            if shouldIBreak:
+                break
     #went through all tries or found a motif with acceptable number of sites
-    #if no valid motif found, then exit
+    #if no valid motif found, then there is nothing to return
     if len(logevs) == 0:
         print 'No motif found, so do nothing...'
-        sys.exit()
+        return None
     best_index = argmin(logevs)
     best_theta_motif = theta_motifs[best_index]
     best_theta_background_matrix = theta_background_matrices[best_index]
@@ -447,7 +706,7 @@ def extreme(Y,neg_seqs,minsites,maxsites,pwm_guess,initialstep=0.05,tries=15,rev
     discovered_theta_motifs.append(best_theta_motif)
     discovered_theta_background_matrices.append(best_theta_background_matrix)
     discovered_logevs.append(best_logev)
-    pos_nsites, neg_nsites = erase_motif(best_theta_motif, best_theta_background_matrix, best_lambda_motif, pos_seqs, neg_seqs)
+    pos_nsites, neg_nsites = erase_motif(best_theta_motif, best_theta_background_matrix, best_lambda_motif, pos_seqs, neg_seqs, erase=erase)
     discovered_nonoverlapsites.append(pos_nsites)
     return all_theta_motifs, all_theta_background_matrices, all_lambda_motifs, all_logevs, \
         discovered_theta_motifs, discovered_theta_background_matrices,discovered_logevs, \
@@ -462,39 +721,74 @@ and checks whether G exceeds the threshold (default: 0.7).
 Input: 
 theta_motif, the PWM (assumed to be trimmed already)
 theta_background_matrix, background frequencies, same size as theta_motif
-Is, list of list of indicator matrices
+X, strided windows of the packed dataset (from PackedSequences.windows)
+starts, array of valid window start positions
 
 Output:
 pos, guess for the number of positive sites
 """
-def guess_positive_sites(theta_motif, theta_background_matrix, Is, Gthresh=0.7):
+def guess_positive_sites(theta_motif, theta_background_matrix, X, starts, Gthresh=0.7):
     logodds_matrix = log(theta_motif/theta_background_matrix)#spec matrix
     Vmax = logodds_matrix.max(axis=1).sum()
-    pos = 0
-    for J in Is:
-        for I in J:
-            if I is None:
-                continue
-            G = max(goodness_fit(logodds_matrix, Vmax, I),goodness_fit(logodds_matrix, Vmax, I_rc(I)))
-            pos += G > Gthresh
+    V, Vr = scan_windows(logodds_matrix, X, starts)
+    G = maximum(V/Vmax, Vr/Vmax)#goodness of fit on the better strand
+    pos = int((G > Gthresh).sum())
     return pos
 
+"""
+Scores every window of the dataset with a log-odds matrix, on both strands, in one
+pass. Instead of one indicator matrix per window, the scores are built up as a
+sliding sum over the columns of the log-odds matrix: column k adds its entry for
+the letter at offset k of every window at once. Row k of X is a strided view,
+so X[starts,k] gathers those letters without copying windows.
+
+The scores are the same as sum(spec*I) and sum(spec*I_rc(I)) for the indicator
+matrix I of each window.
+
+Input:
+spec, the log-odds matrix, Wx4
+X, strided windows of the packed dataset (from PackedSequences.windows)
+starts, array of valid window start positions
+revcomp, whether to score the reverse complement strand too (default: True)
+
+Output:
+scores, array of forward strand scores, one per start
+rcscores, array of reverse complement strand scores, one per start. None if revcomp is False
+"""
+def scan_windows(spec, X, starts, revcomp=True):
+    W = spec.shape[0]
+    scores = zeros(len(starts))
+    rcscores = zeros(len(starts)) if revcomp else None
+    spec_rc = I_rc(spec)#scoring the reverse complement of I with spec is scoring I with the reversed spec
+    for k in range(W):
+        x = X[starts,k]#letter at offset k of every window
+        scores += spec[k][x]
+        if revcomp:
+            rcscores += spec_rc[k][x]
+    return scores, rcscores
 
 """
-Calculates goodness of fit, G.
+Finds the motif sites in the dataset. A window is a site if its log-odds score on
+either strand exceeds the threshold t. This is the vectorized version of checking
+sum(spec*I) > t window by window.
 
 Input:
-logodds_matrix, the log odds matrix
-I, an indicator matrix for a subsequence
-Vmax, maximum log-odd score
+spec, the log-odds matrix, Wx4
+t, the score threshold
+X, strided windows of the packed dataset (from PackedSequences.windows)
+starts, array of valid window start positions
+revcomp, whether to search both strands (default: True)
 
 Output:
-G - the goodness of fit
+hits, boolean array, one per start. True if the window is a site
 """
-def goodness_fit(logodds_matrix, Vmax, I):
-    V = sum(logodds_matrix*I)
-    G = V/Vmax
-    return G
+def find_sites(spec, t, X, starts, revcomp=True):
+    scores, rcscores = scan_windows(spec, X, starts, revcomp)
+    hits = scores > t
+    if revcomp:
+        hits |= rcscores > t
+    return hits
+
 
 """
 Searches for motif instances in the positive and negative sequences and replaces
@@ -506,72 +800,61 @@ Input:
 theta_motif, the PWM (assumed to be trimmed already)
 theta_background_matrix, background frequencies, same size as theta_motif
 lambda_motif, fraction of subsequences that are generated by motif
-pos_seqs, list of positive sequences
-neg_seqs, list of negative sequences
+pos_seqs, sequence.PackedSequences of positive sequences
+neg_seqs, sequence.PackedSequences of negative sequences, or None if there are none
 
 Output:
-Updated positive and negative sequences with motif sites deleted
-Also output number of sites erased in both sequence sets
+Number of sites erased in both sequence sets. Unless erase is False, the sites are set to N
+in the sequences (sequence.PackedSequences) in place
 """
-def erase_motif(theta_motif, theta_background_matrix, lambda_motif, pos_seqs, neg_seqs, revcomp=True):
-    t = log((1-lambda_motif)/lambda_motif)#Threshold
-    spec = log(theta_motif/theta_background_matrix)#spec matrix
-    W = theta_motif.shape[0]#width of the motif
-    ens = W * 'N'#N sequence to replace motif sites with
-    pos_nsites_dis = 0
+def erase_motif(theta_motif, theta_background_matrix, lambda_motif, pos_seqs, neg_seqs, revcomp=True, erase=True):
     print 'Erasing motif from positive sequences'
-    for i in range(len(pos_seqs)):
-        s = pos_seqs[i]#grab the string
-        L = len(s)
-        end = L - W + 1#go to last W-mer of sequence
-        j = 0
-        while j < end:
-            subs = s[j:j+W]#grab the subsequence
-            if 'N' in subs:#ignore subsequences with deleted portions
-                j += 1
-                continue
-            I = sequenceToI(subs)#subsequence has no deleted portions, so make indicator matrix
-            if revcomp:
-                #a is boolean that tells whether a hit is found
-                a = sum(spec*I) > t or sum(spec*I_rc(I)) > t
-            else:
-                a = sum(spec*I) > t
-            if a:#hit found, increment, erase, and move index
-                pos_nsites_dis += 1
-                s = s[0:j] + ens + s[j+W:]
-                j += W
-            else:#no hit found, move index up by 1
-                j += 1
-        pos_seqs[i] = s#done erasing, store result
+    pos_sites = erase_motif_packed(theta_motif, theta_background_matrix, lambda_motif, pos_seqs, revcomp, erase)
+    pos_nsites_dis = len(pos_sites)
     print 'Erased ' + str(pos_nsites_dis) + ' sites from the positive sequences'     
+    if neg_seqs is None:
+        return (pos_nsites_dis, 0)
     print 'Erasing motif from negative sequences'   
-    neg_nsites_dis = 0
-    for i in range(len(neg_seqs)):
-        s = neg_seqs[i]#grab the string
-        L = len(s)
-        end = L - W + 1#go to last W-mer of sequence
-        j = 0
-        while j < end:
-            subs = s[j:j+W]#grab the subsequence
-            if 'N' in subs:#ignore subsequences with deleted portions
-                j += 1
-                continue
-            I = sequenceToI(subs)#subsequence has no deleted portions, so make indicator matrix
-            if revcomp:
-                #a is boolean that tells whether a hit is found
-                a = sum(spec*I) > t or sum(spec*I_rc(I)) > t
-            else:
-                a = sum(spec*I) > t
-            if a:#hit found, increment, erase, and move index
-                neg_nsites_dis += 1
-                s = s[0:j] + ens + s[j+W:]
-                j += W
-            else:#no hit found, move index up by 1
-                j += 1
-        neg_seqs[i] = s#done erasing, store result
+    neg_sites = erase_motif_packed(theta_motif, theta_background_matrix, lambda_motif, neg_seqs, revcomp, erase)
+    neg_nsites_dis = len(neg_sites)
     print 'Erased ' + str(neg_nsites_dis) + ' sites from the negative sequences'
     return (pos_nsites_dis, neg_nsites_dis)
 
+"""
+Erases motif instances from one sequence.PackedSequences object, in place, by setting
+their letter codes to N. All windows are scored at once with find_sites. The hits are
+then taken from left to right, and a hit closer than W to the last kept one is dropped,
+so erased sites never overlap. This is the same greedy choice as walking the sequence and
+jumping W positions after every hit, but only the hits are looked at in Python.
+
+Input: 
+theta_motif, the PWM (assumed to be trimmed already)
+theta_background_matrix, background frequencies, same size as theta_motif
+lambda_motif, fraction of subsequences that are generated by motif
+seqs, sequence.PackedSequences to erase the motif from
+erase, if False the sites are only found and seqs is left untouched (default: True)
+
+Output:
+sites, array of start positions (into seqs.codes) of the erased sites. seqs.seqIndex(sites)
+gives the sequence of each site
+"""
+def erase_motif_packed(theta_motif, theta_background_matrix, lambda_motif, seqs, revcomp=True, erase=True):
+    t = log((1-lambda_motif)/lambda_motif)#Threshold
+    spec = log(theta_motif/theta_background_matrix)#spec matrix
+    W = theta_motif.shape[0]#width of the motif
+    starts = seqs.validStarts(W)#windows with deleted portions are never valid starts
+    hits = starts[find_sites(spec, t, seqs.windows(W), starts, revcomp)]
+    keep = zeros(len(hits), dtype=bool)
+    nextfree = 0#first position that is not covered by a kept site
+    for i in xrange(len(hits)):
+        if hits[i] >= nextfree:
+            keep[i] = True
+            nextfree = hits[i] + W
+    sites = hits[keep]
+    if erase:
+        seqs.erase(sites, W)
+    return sites
+
 
 """
 Given an indicator matrix, return its reverse complement.
@@ -590,28 +873,21 @@ Finds the number of discrete motif sites. Uses the threshold decision theory str
 from Bailey and Elkan. Currently searches both strands.
 
 Input:
-Is, list of lists of indicator matrices. dataset of sequences
 theta_motif, motif PWM matrix
 theta_background_matrix, background PWM matrix
 lambda_motif, motif frequency
+X, strided windows of the packed dataset (from PackedSequences.windows)
+starts, array of valid window start positions
 
 Output:
 nsites_dis, integer number of discovered motif sites
 
 """
-def get_nsites_dis(theta_motif, theta_background_matrix, lambda_motif, Is, revcomp=True):
+def get_nsites_dis(theta_motif, theta_background_matrix, lambda_motif, X, starts, revcomp=True):
     t = log((1-lambda_motif)/lambda_motif)#Threshold
     spec = log(theta_motif/theta_background_matrix)#spec matrix
-    nsites_dis = 0#discrete sites discovered
-    for s in Is:
-        for I in s:
-            if I is None:#if this location intersects with a deleted base pair, go to next loop step
-                continue
-            if revcomp:
-                a = sum(spec*I) > t or sum(spec*I_rc(I)) > t
-            else:
-                a = sum(spec*I) > t
-            nsites_dis += a
+    #windows intersecting a deleted base pair are not in starts
+    nsites_dis = int(find_sites(spec, t, X, starts, revcomp).sum())#discrete sites discovered
     return nsites_dis
 
 # print very large or small numbers
@@ -698,68 +974,94 @@ def outputMEMEformat(disc_pwms, disc_bkg, disc_logevs, disc_nsites, outpre, use_
     f.close()        
 
 """
-The main executable function
+Reads all PWM seeds from a seed file, such as the output of Consensus2PWM.py. Each seed
+is a name line (>name consensus) followed by one row of the PWM for each letter of the
+consensus.
+
+Input:
+jfilename, name of the seed file
+
+Output:
+seeds, list of (motifname, pwm) tuples, in file order
 """
-def main():
-    usage = "usage: %prog [options] <input FASTA>"
-    description = "The program applies a modified EXTREME algorithm to find motifs in a FASTA file. It accepts a positive sequence set, a negative sequence set, a list of seed PFMs, and an index number indicating which of the seed PFMs to use"
-    parser = ArgumentParser(description=description)
-    parser.add_argument('fastafile', metavar='f', help='FASTA file containing the sequences')
-    parser.add_argument('negfastafile', metavar='g', help='Negative FASTA file. This is for comparison so that you know the motif you discovered is over-represented.')
-    parser.add_argument('jfile', metavar='j', help='File containing PWM seeds')
-    parser.add_argument('indexvalue', metavar='i', help='Which seed from the Minimal MEME Format file to use (it is an integer ranging from 1 to the total number of PFM seeds in your file)', type=int)
-    parser.add_argument("-p", "--pseudocounts", help="Pseudo counts added to initial PFM guess. Default:0.0", type=float, default=0.0)
-    parser.add_argument("-q", "--initialstep", help="The initial step size for the online EM algorithm. A VERY sensitive parameter. I get best success for ChIP size data (about 100,000 to 1,000,000 bps) with a step size of 0.05. For DNase footprinting, which usually has >5,000,000 bps, I find 0.02 works best. Default:0.05", type=float, default=0.05)    
-    parser.add_argument("-maxsites", dest="maxsites", help="Maximum number of expected sites for the motif. If not specified, defaults to 5 times number of initial predicted sites.", type=int, default=0)
-    parser.add_argument("-minsites", dest="minsites", help="Minimum number of expected sites for the motif. Default: 10", type=int, default=10)
-    parser.add_argument("-t", "--tries", dest="tries", help="Number of tries for each motif discovered. The fudge factor is changed until the number of discovered sites is in the \"acceptable\" range", type=int, default=15)
-    parser.add_argument("-s", "--seed", dest="seed", help="Random seed", type=int, default=1)
-    parser.add_argument("-saveseqs", "--saveseqs", dest="saveseqs", help="If specified, save sequences to current directory", action='store_true')
-    parser.add_argument("-b", "--background", dest="background", help="If specified, the minimal MEME output will use the calculated background probabilities instead of uniform probabilities.", action='store_true')
-    import time
-    print "Started at:"
-    print time.ctime()
-    starttime = time.time()
-    args = parser.parse_args()
-    seed = args.seed
-    initialstep = args.initialstep
-    minsites = args.minsites
-    maxsites = args.maxsites
-    random.seed(seed)
-    jfile = open(args.jfile,'r')
+def read_seeds(jfilename):
     from numpy import fromstring
-    from string import join
+    jfile = open(jfilename,'r')
     lines = jfile.readlines()
-    j = 0
+    jfile.close()
+    seeds = list()
     for i in range(len(lines)):
         line = lines[i]
         if '>' in line:#This is a name line, so read in next lines for matrix
-            j += 1
-            if j == args.indexvalue:#at the desired index
-                parts = lines[i].split()
-                pos_cs = parts[1]
-                motifname = parts[0][1:]
-                w = len(pos_cs)
-                strlines = lines[i+1:i+1+w]
-                pwm_string = ''
-                for strline in strlines:
-                    strparts = strline.split()
-                    for strpart in strparts:
-                        pwm_string += strpart + ' '
-                #print pwm_string
-                pwm_guess = fromstring(pwm_string,sep=' ',dtype=float)
-                pwm_guess = pwm_guess.reshape((w,4))
-                break
-    print 'Using initial motif guess',motifname
-    print 'Adding',str(args.pseudocounts),'pseudocounts and normalizing'
-    pwm_guess = pwm_guess + args.pseudocounts
+            parts = line.split()
+            pos_cs = parts[1]
+            motifname = parts[0][1:]
+            w = len(pos_cs)
+            pwm_string = ' '.join(lines[i+1:i+1+w])
+            pwm_guess = fromstring(pwm_string,sep=' ',dtype=float)
+            pwm_guess = pwm_guess.reshape((w,4))
+            seeds.append((motifname, pwm_guess))
+    return seeds
+
+"""
+Opens the PWM seeds of a seed file (see read_seeds), or of a binary seed bundle written by
+Consensus2PWM.py -binary. A bundle is not read up front, each seed is loaded when it is used.
+
+Input:
+jfilename, name of the seed file or of the seed bundle folder
+
+Output:
+seeds, sequence of (motifname, pwm) tuples, in file order
+"""
+def load_seeds(jfilename):
+    import os
+    if os.path.isdir(jfilename):
+        import Consensus2PWM
+        return Consensus2PWM.SeedBundle(jfilename)
+    return read_seeds(jfilename)
+
+"""
+Turns a seed selection such as "all" or "1-10,15" into a sorted list of seed indices.
+Indices start at 1, like the index value argument.
+
+Input:
+seedlist, the selection string
+nseeds, number of seeds in the seed file
+
+Output:
+indices, sorted list of distinct seed indices
+"""
+def parse_seed_list(seedlist, nseeds):
+    if seedlist == 'all':
+        return range(1, nseeds+1)
+    indices = set()
+    for part in seedlist.split(','):
+        try:
+            if '-' in part:
+                first, last = [int(x) for x in part.split('-')]
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError("invalid seed selection: " + part)
+        if first < 1 or last > nseeds or first > last:
+            raise ValueError("seed selection " + part + " is outside of 1-" + str(nseeds))
+        indices.update(range(first, last+1))
+    return sorted(indices)
+
+"""
+Adds pseudocounts to a seed PFM and normalizes its rows.
+"""
+def normalize_seed(pwm_guess, pseudocounts):
+    print 'Adding',str(pseudocounts),'pseudocounts and normalizing'
+    pwm_guess = pwm_guess + pseudocounts
     pwm_guess = pwm_guess/pwm_guess.sum(axis=1)[:,newaxis]
-    jfile.close() 
-   
-    # make the directory (recursively)
+    return pwm_guess
+
+"""
+Makes an output folder (recursively). An existing folder is reused.
+"""
+def make_outdir(outdir):
     import os
-    outdir = motifname
-    outpre = outdir + "/"
     clobber = True
     try:#adapted from DREME.py by T. Bailey
         os.makedirs(outdir)
@@ -769,14 +1071,20 @@ def main():
                 print >> sys.stderr, ("output directory (%s) already exists "
                 "but EXTREME was not told to clobber it") % (outdir); sys.exit(1)
         else: raise
-    #Use DREME's SeqIO to read in FASTA to list
-    seqs = sequence.convert_ambigs(sequence.readFASTA(args.fastafile, None, True))
-    #print seqs
-    negseqs = sequence.convert_ambigs(sequence.readFASTA(args.negfastafile, None, True))
-    tries = args.tries
-    theta_motifs, theta_background_matrices, lambda_motifs, logevs, disc_pwms, disc_bkg, disc_logevs, disc_nsites = extreme(seqs,negseqs,minsites,maxsites,pwm_guess,initialstep,tries)
+
+"""
+Writes the minimal MEME output of the discovered motifs and, if Weblogolib is installed,
+a logo of every try.
+
+Input:
+outpre, the prefix of the output files
+theta_motifs, theta_background_matrices, lambda_motifs, logevs, results of all tries
+disc_pwms, disc_bkg, disc_logevs, disc_nsites, results of the discovered motifs
+use_bkg, whether the MEME output uses the learned background
+"""
+def write_results(outpre, theta_motifs, theta_background_matrices, lambda_motifs, logevs, disc_pwms, disc_bkg, disc_logevs, disc_nsites, use_bkg=False):
     k = 1
-    outputMEMEformat(disc_pwms, disc_bkg, disc_logevs, disc_nsites, outpre, args.background)
+    outputMEMEformat(disc_pwms, disc_bkg, disc_logevs, disc_nsites, outpre, use_bkg)
     try:
         from weblogolib import LogoData, LogoOptions, LogoFormat, png_formatter, eps_formatter, unambiguous_dna_alphabet
         for theta_motif, theta_background_matrix, lambda_motif, logev in zip(theta_motifs, theta_background_matrices, lambda_motifs, logevs):
@@ -784,20 +1092,233 @@ def main():
             k = k+1
     except ImportError:
         print "You do not have Weblogolib, so sequence logos will not be made"
-    
+
+"""
+Runs EXTREME for one seed and writes the results to a folder named after the seed.
+
+Input:
+motifname, name of the seed, also used as the output folder
+pwm_guess, the PFM of the seed
+seqs, sequence.PackedSequences of positive sequences
+negseqs, sequence.PackedSequences of negative sequences
+args, the parsed command line arguments
+erase, whether the discovered motif is erased from seqs and negseqs (default: True)
+
+Output:
+found, whether a motif with an acceptable number of sites was found. Nothing is written if not
+"""
+def run_seed(motifname, pwm_guess, seqs, negseqs, args, erase=True):
+    print 'Using initial motif guess',motifname
+    pwm_guess = normalize_seed(pwm_guess, args.pseudocounts)
+    outdir = motifname
+    outpre = outdir + "/"
+    make_outdir(outdir)
+    results = extreme(seqs,negseqs,args.minsites,args.maxsites,pwm_guess,args.initialstep,args.tries,batchsize=args.batchsize,erase=erase,fudgeprocs=args.fudgeprocs,threads=args.evthreads)
+    if results is None:
+        return False
+    write_results(outpre, *results, use_bkg=args.background)
+    return True
+
+"""
+Picks the seed that predicts the most sites in the positive sequences, among the seeds that
+have not been used yet. Sites of motifs that were already erased are not counted, so seeds
+that resemble an already discovered motif fall behind.
+
+Input:
+seeds, list of (motifname, pwm) tuples
+remaining, indices (into seeds) of the seeds that can still be used
+seqs, sequence.PackedSequences of positive sequences
+negseqs, sequence.PackedSequences of negative sequences, for the background. If None, seqs is used
+pseudocounts, pseudocounts added to the seeds
+
+Output:
+index of the best remaining seed
+"""
+def next_best_seed(seeds, remaining, seqs, negseqs, pseudocounts):
+    dprobs = get_packed_probs(seqs if negseqs is None else negseqs, 'ACGT')
+    theta_background = array([[dprobs['A'], dprobs['C'], dprobs['G'], dprobs['T']]])
+    best = None
+    best_pos = -1
+    for i in remaining:
+        pwm_guess = seeds[i][1] + pseudocounts
+        pwm_guess = pwm_guess/pwm_guess.sum(axis=1)[:,newaxis]
+        W = pwm_guess.shape[0]
+        pos = guess_positive_sites(pwm_guess, theta_background.repeat(W,axis=0), seqs.windows(W), seqs.validStarts(W))
+        if pos > best_pos:
+            best = i
+            best_pos = pos
+    return best
+
+"""
+Discovers several motifs in one process. After each motif is found, its sites are erased
+from the sequences in memory, and the search starts again from the best of the unused
+seeds (see next_best_seed). A seed that does not give a motif is skipped. Stops when
+nmotifs motifs are found or the seeds run out. All motifs go into the folder named after
+the first seed.
+
+Input:
+seeds, list of (motifname, pwm) tuples
+index, the first seed to use (starts at 1)
+seqs, sequence.PackedSequences of positive sequences
+negseqs, sequence.PackedSequences of negative sequences
+args, the parsed command line arguments
+"""
+def run_motifs(seeds, index, seqs, negseqs, args):
+    outdir = seeds[index-1][0]
+    outpre = outdir + "/"
+    make_outdir(outdir)
+    results = [list() for k in range(8)]#results of all seeds, in the order extreme returns them
+    remaining = range(len(seeds))
+    current = index-1
+    nfound = 0
+    while True:
+        remaining.remove(current)
+        motifname, pwm_guess = seeds[current]
+        print 'Looking for motif',nfound+1,'of',args.nmotifs
+        print 'Using initial motif guess',motifname
+        pwm_guess = normalize_seed(pwm_guess, args.pseudocounts)
+        seed_results = extreme(seqs,negseqs,args.minsites,args.maxsites,pwm_guess,args.initialstep,args.tries,batchsize=args.batchsize,fudgeprocs=args.fudgeprocs,threads=args.evthreads)
+        if seed_results is None:
+            print 'Seed',motifname,'did not find a motif, moving on to the next seed'
+        else:
+            for result, seed_result in zip(results, seed_results):
+                result.extend(seed_result)
+            nfound += 1
+        if nfound == args.nmotifs or len(remaining) == 0:
+            break
+        current = next_best_seed(seeds, remaining, seqs, negseqs, args.pseudocounts)
+    print 'Found',nfound,'motifs'
+    write_results(outpre, *results, use_bkg=args.background)
+
+#data for the worker processes of the multi-seed mode. It is set before the pool is
+#created, so the forked workers all see the same (shared) sequences
+_shared_run = {}
+
+"""
+Worker for the multi-seed mode. Runs one seed on the shared sequences, starting from
+the same random seed as a single-seed run, so results do not depend on the order in
+which seeds are picked up.
+
+Input:
+index, the seed index (starts at 1)
+
+Output:
+(motifname, found), whether a motif with an acceptable number of sites was found
+"""
+def run_shared_seed(index):
+    seqs, negseqs, seeds, args = _shared_run['data']
+    motifname, pwm_guess = seeds[index-1]
+    random.seed(args.seed)
+    return (motifname, run_seed(motifname, pwm_guess, seqs, negseqs, args, erase=False))
+
+"""
+Runs many seeds on a pool of processes that share the sequences (see run_shared_seed).
+Each seed writes to its own folder, as in a single-seed run.
+
+Input:
+seeds, list of (motifname, pwm) tuples
+indices, the seed indices to run (start at 1)
+seqs, sequence.PackedSequences of positive sequences
+negseqs, sequence.PackedSequences of negative sequences, or None
+args, the parsed command line arguments. args.procs processes are used (all CPUs if 0)
+
+Output:
+list of (motifname, found), as returned by run_shared_seed
+"""
+def run_seeds(seeds, indices, seqs, negseqs, args):
+    from multiprocessing import Pool, cpu_count
+    procs = args.procs if args.procs > 0 else cpu_count()
+    print 'Running',len(indices),'seeds on',procs,'processes'
+    _shared_run['data'] = (seqs.toShared(), None if negseqs is None else negseqs.toShared(), seeds, args)
+    pool = Pool(procs)
+    results = pool.map(run_shared_seed, indices, chunksize=1)
+    pool.close()
+    pool.join()
+    for motifname, found in results:
+        if found:
+            print 'Seed',motifname,'found a motif'
+        else:
+            print 'Seed',motifname,'did not find a motif'
+    return results
+
+"""
+The main executable function
+"""
+def main():
+    usage = "usage: %prog [options] <input FASTA>"
+    description = "The program applies a modified EXTREME algorithm to find motifs in a FASTA file. It accepts a positive sequence set, a negative sequence set, a list of seed PFMs, and an index number indicating which of the seed PFMs to use"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('fastafile', metavar='f', help='FASTA file containing the sequences')
+    parser.add_argument('negfastafile', metavar='g', help='Negative FASTA file. This is for comparison so that you know the motif you discovered is over-represented. Use markov to take the background from the letter frequencies of the positive sequences instead, without a negative set.')
+    parser.add_argument('jfile', metavar='j', help='File containing PWM seeds, or a binary seed bundle folder from Consensus2PWM.py -binary')
+    parser.add_argument('indexvalue', metavar='i', help='Which seed from the Minimal MEME Format file to use (it is an integer ranging from 1 to the total number of PFM seeds in your file). Not needed if -seeds is used', type=int, nargs='?')
+    parser.add_argument("-p", "--pseudocounts", help="Pseudo counts added to initial PFM guess. Default:0.0", type=float, default=0.0)
+    parser.add_argument("-q", "--initialstep", help="The initial step size for the online EM algorithm. A VERY sensitive parameter. I get best success for ChIP size data (about 100,000 to 1,000,000 bps) with a step size of 0.05. For DNase footprinting, which usually has >5,000,000 bps, I find 0.02 works best. Default:0.05", type=float, default=0.05)    
+    parser.add_argument("-maxsites", dest="maxsites", help="Maximum number of expected sites for the motif. If not specified, defaults to 5 times number of initial predicted sites.", type=int, default=0)
+    parser.add_argument("-minsites", dest="minsites", help="Minimum number of expected sites for the motif. Default: 10", type=int, default=10)
+    parser.add_argument("-t", "--tries", dest="tries", help="Number of tries for each motif discovered. The fudge factor is changed until the number of discovered sites is in the \"acceptable\" range", type=int, default=15)
+    parser.add_argument("-s", "--seed", dest="seed", help="Random seed", type=int, default=1)
+    parser.add_argument("-saveseqs", "--saveseqs", dest="saveseqs", help="If specified, save sequences to current directory", action='store_true')
+    parser.add_argument("-batchsize", "--batchsize", dest="batchsize", help="Number of subsequences processed together in each online EM update. Values above 1 turn on the mini-batch mode, which is much faster on large datasets. Default: 1", type=int, default=1)
+    parser.add_argument("-seeds", "--seeds", dest="seeds", help="Run many seeds in one go, for example \"all\" or \"1-10,15\". The sequences are read once and shared by a pool of processes. Each seed gets its own output folder, as in a single-seed run", default=None)
+    parser.add_argument("-procs", "--procs", dest="procs", help="Number of processes used by -seeds. Default: number of CPUs", type=int, default=0)
+    parser.add_argument("-fudgeprocs", "--fudgeprocs", dest="fudgeprocs", help="Number of fudge factors to try at the same time, each on its own process. The fudge factor search then narrows its bracket with all of their site counts at once. Cannot be combined with -seeds. Default: 1", type=int, default=1)
+    parser.add_argument("-evthreads", "--evthreads", dest="evthreads", help="Number of threads for the E-values of the tries of a -fudgeprocs round that have an acceptable number of sites. Default: 1", type=int, default=1)
+    parser.add_argument("-nmotifs", "--nmotifs", dest="nmotifs", help="Number of motifs to discover. After each motif, its sites are erased in memory and the search restarts from the best unused seed. All motifs are written to the folder of the first seed. Default: 1", type=int, default=1)
+    parser.add_argument("-b", "--background", dest="background", help="If specified, the minimal MEME output will use the calculated background probabilities instead of uniform probabilities.", action='store_true')
+    print "Started at:"
+    print time.ctime()
+    starttime = time.time()
+    args = parser.parse_args()
+    if args.seeds is None and args.indexvalue is None:
+        parser.error("either an index value or -seeds is needed")
+    if args.seeds is not None and args.saveseqs:
+        parser.error("-saveseqs only works for a single seed")
+    if args.seeds is not None and args.nmotifs > 1:
+        parser.error("-nmotifs only works for a single seed")
+    if args.seeds is not None and args.fudgeprocs > 1:
+        parser.error("-fudgeprocs only works for a single seed, -seeds already uses all processes")
+    seed = args.seed
+    random.seed(seed)
+    seeds = load_seeds(args.jfile)
+    if args.seeds is None:
+        if args.indexvalue < 1 or args.indexvalue > len(seeds):
+            parser.error("index value must be between 1 and " + str(len(seeds)))
+    else:
+        try:
+            indices = parse_seed_list(args.seeds, len(seeds))
+        except ValueError as e:
+            parser.error(str(e))
+    #Use DREME's SeqIO to read in FASTA, packed into one byte per base pair.
+    #If FastaCache.py was run on the files, their binary caches are memory-mapped instead
+    seqs = sequence.readPackedFASTA(args.fastafile)
+    if args.negfastafile == 'markov':
+        negseqs = None
+    else:
+        negseqs = sequence.readPackedFASTA(args.negfastafile)
+    if args.seeds is None:
+        if args.nmotifs > 1:
+            run_motifs(seeds, args.indexvalue, seqs, negseqs, args)
+        else:
+            motifname, pwm_guess = seeds[args.indexvalue-1]
+            if not run_seed(motifname, pwm_guess, seqs, negseqs, args):
+                sys.exit()
+    else:
+        run_seeds(seeds, indices, seqs, negseqs, args)
     
     if args.saveseqs:
         print "Saving Positive sequences to Positive_seq.fa"
         pos_file = open("Positive_seq.fa","w")
         for s in range(len(seqs)):
             pos_file.write(">sequence"+str(s+1)+"\n")
-            pos_file.write(seqs[s]+"\n")
+            pos_file.write(seqs.getString(s)+"\n")
         pos_file.close()
+    if args.saveseqs and negseqs is not None:
         print "Saving Negative sequences to Negative_seq.fa"
         neg_file = open("Negative_seq.fa","w")
         for s in range(len(negseqs)):
             neg_file.write(">sequence"+str(s+1)+"\n")
-            neg_file.write(negseqs[s]+"\n")
+            neg_file.write(negseqs.getString(s)+"\n")
         neg_file.close()
     print "Ended at:"
     print time.ctime()
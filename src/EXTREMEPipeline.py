@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import hashlib
+import imp
+import os
+import random
+import shutil
+import sys
+import time
+import sequence
+import GappedKmerSearch
+import WordSeeds
+import Consensus2PWM
+import EXTREME
+
+"""
+Runs the whole EXTREME workflow in one process: the negative sequences, the word search,
+the clustering into seeds and the online EM for every seed. The output of each stage
+before the EM is cached in a folder named after the stage and a key, the SHA-1 of the
+parameters of the stage and the keys of its inputs. The keys of the sequences are the
+SHA-1 of their packed letters, so a stage is only run again when something it depends on
+has changed, and a run that only changes EM parameters reuses everything else.
+"""
+
+def stage_key(name, *parts):
+    """ Key of a stage, from its name, its parameters and the keys of its inputs
+    """
+    return hashlib.sha1(repr((name,) + parts)).hexdigest()
+
+def run_stage(report, cachedir, name, key, make):
+    """ Runs make(stagedir) to write the output of a stage to its folder, unless the
+    folder already holds the output for this key. The folder is only complete once its
+    marker file is written, so an interrupted stage is run again. Adds the name of the
+    stage, its wall time and whether it was cached to report. Returns the folder.
+    """
+    stagedir = os.path.join(cachedir, name + "-" + key)
+    marker = os.path.join(stagedir, "done")
+    start = time.time()
+    hit = os.path.isfile(marker)
+    if hit:
+        print 'Using the cached', name, 'in', stagedir
+    else:
+        if os.path.isdir(stagedir):
+            shutil.rmtree(stagedir)
+        os.makedirs(stagedir)
+        make(stagedir)
+        open(marker, 'w').close()#the marker goes last
+    report.append((name, time.time()-start, hit))
+    return stagedir
+
+def read_packed(filename):
+    """ Reads a FASTA file as packed sequences, like sequence.readPackedFASTA. Also returns
+    whether they came from the binary cache of the file (see FastaCache.py)
+    """
+    packed = sequence.loadPackedCache(filename)
+    if packed is not None:
+        return packed, True
+    return sequence._packFASTA(filename), False
+
+def shuffle_sequences(seqs, filename, seed, procs=1):
+    """ Writes a dinucleotide shuffled copy of packed sequences to a FASTA file, the same
+    as fasta-dinucleotide-shuffle.py with the same seed. Ambiguous letters are already N
+    in packed sequences, so they are shuffled as N
+    """
+    shuffle = imp.load_source('fasta_dinucleotide_shuffle', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fasta-dinucleotide-shuffle.py'))
+    records = ((j, seqs.getName(j), seqs.getString(j), seed, 1, "") for j in xrange(seqs.getNumSeqs()))
+    output = open(filename, 'w')
+    shuffle.shuffleRecords(records, procs, output)
+    output.close()
+
+def print_report(report):
+    """ Prints the wall time of each stage and whether its output was cached
+    """
+    print 'Stage\tTime (s)\tCached'
+    for name, seconds, hit in report:
+        print '%s\t%.2f\t%s' % (name, seconds, 'yes' if hit else 'no')
+    print 'Total\t%.2f\t%d of %d stages' % (sum([r[1] for r in report]), len([r for r in report if r[2]]), len(report))
+
+"""
+The main executable function
+"""
+def main():
+    usage = "usage: %prog [options] <fasta file> <negative fasta file> <output folder>"
+    description = "Runs EXTREME from a FASTA file to motifs in one go: shuffling the negative sequences, finding words, clustering them into seeds and running the online EM on the seeds. Each stage is cached, so only the stages whose inputs or parameters changed are run again"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('fastafile', metavar='f', help='FASTA file containing the sequences')
+    parser.add_argument('negativefile', metavar='n', help='FASTA file containing the negative sequences, shuffle to use a dinucleotide shuffle of the sequences, or markov to use a first order Markov model of the sequences instead')
+    parser.add_argument('outdir', metavar='o', help='Output folder. Each seed writes its motifs to a folder in it, and the seeds are written to seeds.wm')
+    parser.add_argument("-cachedir", "--cachedir", dest="cachedir", help="Folder of the cached stages. Default: cache in the output folder", default=None)
+    parser.add_argument("-l", dest="halflength", help="Number of non-degenerate letters per half-site of the words. Default: 4", type=int, default=4)
+    parser.add_argument("-ming", dest="mingap", help="Minimum gap of the words. Default: 0", type=int, default=0)
+    parser.add_argument("-maxg", dest="maxgap", help="Maximum gap of the words. Default: 10", type=int, default=10)
+    parser.add_argument("-wordminsites", "--wordminsites", dest="wordminsites", help="Minimum number of sites for a word to be included. Default: 10", type=int, default=10)
+    parser.add_argument("-z", "--zthresh", dest="zthresh", help="Corrected z-score threshold of the words. Default: 5", type=float, default=5)
+    parser.add_argument("-threshold", "--threshold", dest="threshold", help="Largest average distance (1 - similarity) at which two clusters of words are merged. Default: 0.3", type=float, default=0.3)
+    parser.add_argument("-seeds", "--seeds", dest="seeds", help="Seeds to run the online EM on, for example \"all\" or \"1-10,15\". Default: all", default='all')
+    parser.add_argument("-procs", "--procs", dest="procs", help="Number of processes for the shuffle, the word counts and the seeds. Default: number of CPUs", type=int, default=0)
+    parser.add_argument("-p", "--pseudocounts", help="Pseudo counts added to the seeds. Default:0.0", type=float, default=0.0)
+    parser.add_argument("-q", "--initialstep", help="The initial step size for the online EM algorithm. Default:0.05", type=float, default=0.05)
+    parser.add_argument("-maxsites", dest="maxsites", help="Maximum number of expected sites for the motif. If not specified, defaults to 5 times number of initial predicted sites.", type=int, default=0)
+    parser.add_argument("-minsites", dest="minsites", help="Minimum number of expected sites for the motif. Default: 10", type=int, default=10)
+    parser.add_argument("-t", "--tries", dest="tries", help="Number of tries for each motif discovered. Default: 15", type=int, default=15)
+    parser.add_argument("-s", "--seed", dest="seed", help="Random seed, for the shuffle and the online EM. Default: 1", type=int, default=1)
+    parser.add_argument("-batchsize", "--batchsize", dest="batchsize", help="Number of subsequences processed together in each online EM update. Default: 1", type=int, default=1)
+    parser.add_argument("-b", "--background", dest="background", help="If specified, the minimal MEME output will use the calculated background probabilities instead of uniform probabilities.", action='store_true')
+    args = parser.parse_args()
+    args.fudgeprocs = 1#the seeds already use all processes
+    args.evthreads = 1
+    from multiprocessing import cpu_count
+    procs = args.procs if args.procs > 0 else cpu_count()
+    outdir = os.path.abspath(args.outdir)
+    cachedir = os.path.abspath(args.cachedir) if args.cachedir is not None else os.path.join(outdir, "cache")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    report = []
+    start = time.time()
+    seqs, hit = read_packed(args.fastafile)
+    pos_key = GappedKmerSearch.packed_key(seqs)
+    negseqs = None
+    neg_key = args.negativefile
+    if args.negativefile not in ('markov', 'shuffle'):
+        negseqs, neg_hit = read_packed(args.negativefile)
+        neg_key = GappedKmerSearch.packed_key(negseqs)
+        hit = hit and neg_hit
+    report.append(('read', time.time()-start, hit))#cached if every FASTA file came from its cache
+    if args.negativefile == 'shuffle':
+        neg_key = stage_key('negatives', pos_key, args.seed)
+        stagedir = run_stage(report, cachedir, 'negatives', neg_key, lambda d: shuffle_sequences(seqs, os.path.join(d, "negatives.fa"), args.seed, procs))
+        negseqs = sequence.readPackedFASTA(os.path.join(stagedir, "negatives.fa"))
+    gaps = (args.halflength, args.mingap, args.maxgap)
+    counts_keys = []
+    counts_files = []
+    for name, packed, key in (('poscounts', seqs, pos_key), ('negcounts', negseqs, neg_key)):
+        if packed is None:
+            counts_keys.append(key)
+            counts_files.append(None)
+            continue
+        counts_key = stage_key(name, key, *gaps)
+        stagedir = run_stage(report, cachedir, name, counts_key, lambda d: GappedKmerSearch.get_word_counts(packed, args.halflength, args.mingap, args.maxgap, procs, os.path.join(d, "counts.npz")))
+        counts_keys.append(counts_key)
+        counts_files.append(os.path.join(stagedir, "counts.npz"))
+    words_key = stage_key('words', counts_keys[0], counts_keys[1], gaps, args.wordminsites, args.zthresh)
+    stagedir = run_stage(report, cachedir, 'words', words_key, lambda d: GappedKmerSearch.find_kmers(seqs, negseqs, args.halflength, args.mingap, args.maxgap, args.wordminsites, args.zthresh, os.path.join(d, "words"), procs, counts_files[0], counts_files[1]))
+    wordsfile = os.path.join(stagedir, "words")
+    def make_seeds(d):
+        PWM_dict = WordSeeds.get_seeds(WordSeeds.read_kmers(wordsfile), args.threshold)
+        Consensus2PWM.write_PWMs(os.path.join(d, "seeds.wm"), PWM_dict)
+        Consensus2PWM.write_seed_bundle(os.path.join(d, "seeds"), PWM_dict)
+    stagedir = run_stage(report, cachedir, 'seeds', stage_key('seeds', words_key, args.threshold), make_seeds)
+    shutil.copy(os.path.join(stagedir, "seeds.wm"), os.path.join(outdir, "seeds.wm"))
+    seeds = Consensus2PWM.SeedBundle(os.path.join(stagedir, "seeds"))
+    try:
+        indices = EXTREME.parse_seed_list(args.seeds, len(seeds))
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.time()
+    random.seed(args.seed)
+    os.chdir(outdir)#each seed writes to a folder named after it
+    args.procs = procs
+    EXTREME.run_seeds(seeds, indices, seqs, negseqs, args)
+    report.append(('EM', time.time()-start, False))
+    print_report(report)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import sequence
+
+"""
+Writes the binary cache of one or more FASTA files. The cache is a folder named after
+the FASTA file with .cache appended. EXTREME.py and GappedKmerSearch.py memory-map the
+cache instead of parsing the FASTA file whenever the cache matches the file (by its
+SHA-1), so it only needs to be written once for datasets that are used over and over.
+fasta-dinucleotide-shuffle.py always parses the FASTA file, since it keeps the ambiguous
+letters that the cache converts to N.
+"""
+def main():
+    usage = "usage: %prog [options] <FASTA files>"
+    description = "Writes a binary cache of FASTA files for faster reading"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('fastafiles', metavar='f', nargs='+', help='FASTA files to cache')
+    args = parser.parse_args()
+    for fastafile in args.fastafiles:
+        packed = sequence.writePackedCache(fastafile)
+        print 'Cached', packed.getNumSeqs(), 'sequences,', packed.getLen(), 'bps of', fastafile
+
+if __name__=='__main__':
+    main()
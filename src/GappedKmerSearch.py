@@ -5,95 +5,514 @@ import sequence
 from math import sqrt
 from numpy import *
 
-def count_seqs_with_words(seqs, halflength, ming, maxg):
-    gapped_seqs_with_words = {}#each key is the gap length
-    for g in range(ming,maxg+1):
-        seqs_with_words = {}#the current dictionary for the gaps
-        gapped_seqs_with_words[g] = seqs_with_words
-        print "Looking for k-mers of gap", g
-        w = g+2*halflength
-        for seq in seqs:
-            slen = len(seq)
-            for i in range(0, slen-w+1):
-                word = seq[i : i+w]
-                # skip word if either half-site contains an ambiguous character
-                if "N" in word[0:halflength] or "N" in word[-halflength:]:
-                    continue
-                #convert word to a gapped word. Only the first and last halflength letters are preserved
-                word = word[0:halflength] + g*"N" + word[-halflength:]
-                update_seqs_with_words(seqs_with_words, word)
-    return gapped_seqs_with_words
-
-def update_seqs_with_words(seqs_with_words, word):
-    #use the lower alphabet word for rc
-    word = min(word, get_rc(word))
-    if seqs_with_words.has_key(word):#word has been encountered before, add 1
-        seqs_with_words[word] += 1
-    else:#word has not been encountered before, create new key
-        seqs_with_words[word] = 1
-
 def get_rc(re):
     """ Return the reverse complement of a DNA RE.
     """
     return re.translate(string.maketrans("ACGTURYKMBVDHSWN", "TGCAAYRMKVBHDSWN"))[::-1]
 
-def get_zscores(pos_seq_counts,neg_seq_counts):
-    results = {}
-    for g in pos_seq_counts:
-        results[g] = {}
-        for word in pos_seq_counts[g]:
-            p = pos_seq_counts[g][word]
-            if (neg_seq_counts[g].has_key(word)):
-                n = neg_seq_counts[g][word]
-            else:
-                n = 1
-            zscore = 1.0*(p - n)/sqrt(n)
-            results[g][word] = zscore
-    return results
-
-#returns the words in order, from largest to smallest, by z-scores
-def sorted_zscore_keys(zscores):
-    keys = {}
-    for g in zscores:
-        keys[g] = sorted(zscores[g], key=zscores[g].__getitem__, reverse=True)
-    return keys
-
-def find_kmers(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, zthresh, outputfile):
-    print 'Counting words in positive sequences...'
-    pos_seq_counts = count_seqs_with_words(pos_seqs, halflength, ming, maxg)
-    print 'Counting words in negative sequences...' 
-    neg_seq_counts = count_seqs_with_words(neg_seqs, halflength, ming, maxg)
-    print 'Calculating z-scores...'
-    zscores = get_zscores(pos_seq_counts,neg_seq_counts)
-    print 'Sorting keys by z-scores...'
-    sorted_keys = sorted_zscore_keys(zscores)
-    output = open(outputfile,'w')
+"""
+Integer-encoded counting of gapped words in PackedSequences.
+A half-site of halflength letters is a 2*halflength bit integer (A=0, C=1, G=2, T=3, first letter
+in the highest bits), and a gapped word is its left half-site code followed by its right half-site
+code. The gap is implied by which count table the word is in. Because the gap is the same in a word
+and its reverse complement, comparing codes orders words exactly like comparing their strings, so
+the canonical word (the lower of the word and its reverse complement) is a minimum of two integers.
+"""
+def get_halfsite_codes(packed, halflength, lo=0, hi=None):
+    """ Half-site codes of the windows that start at positions lo to hi-1 of the packed codes,
+    whether each window is a valid half-site (inside one sequence and without N),
+    and the sequence each window starts in.
+    """
+    X = packed.windows(halflength)
+    hi = len(X) if hi is None else min(hi, len(X))
+    X = X[lo:hi]
+    codes = X.dot(4**arange(halflength-1, -1, -1))
+    seqids = packed.seqIndex(arange(lo, hi))
+    valid = (X != sequence._N_CODE).all(axis=1) & (seqids == packed.seqIndex(arange(lo, hi) + halflength - 1))
+    return codes, valid, seqids
+
+def get_rc_codes(halflength):
+    """ Reverse complement of every half-site code.
+    """
+    rc = zeros(4**halflength, dtype=int64)
+    codes = arange(4**halflength)
+    for j in range(halflength):
+        rc = rc*4 + (3 - codes/4**j%4)
+    return rc
+
+def gapped_word_blocks(packed, halflength, ming, maxg, blocksize=1<<20):
+    """ Sweeps once over packed sequences, blocksize positions at a time, and yields an array of the
+    canonical codes of the gapped words of all gaps that start in each block. Each left half-site is
+    paired with the right half-site of every gap, and the words of different gaps are kept apart by
+    adding the gap index times 4^(2*halflength). Memory only depends on blocksize.
+    """
+    rc = get_rc_codes(halflength)
+    shift = 4**halflength
+    nwords = shift*shift#number of words of one gap
+    dists = halflength + arange(ming, maxg+1)#distance from the left half-site to the right one
+    n = len(packed.windows(halflength))
+    for b in range(0, n, blocksize):
+        e = min(b+blocksize, n)
+        #the half-sites of the block, and the right half-sites of the words that start in it
+        halfcodes, valid, seqids = get_halfsite_codes(packed, halflength, b, e + halflength + maxg)
+        starts = nonzero(valid[:e-b])[0]
+        ends = starts[:,newaxis] + dists
+        inside = ends < len(halfcodes)
+        ends = where(inside, ends, 0)
+        #both half-sites valid, and in the same sequence
+        rows, cols = nonzero(inside & valid[ends] & (seqids[ends] == seqids[starts][:,newaxis]))
+        left = halfcodes[starts[rows]]
+        right = halfcodes[ends[rows,cols]]
+        yield minimum(left*shift + right, rc[right]*shift + rc[left]) + cols*nwords
+
+def is_dense(halflength, ming, maxg):
+    """ Whether the words of all gaps are few enough to be tallied with bincount instead of sorting.
+    """
+    return (maxg-ming+1)*4**(2*halflength) <= 1<<23
+
+def count_words_packed(packed, halflength, ming, maxg, blocksize=1<<20):
+    """ Counts the gapped words in packed sequences. Returns, for each gap, the sorted array of
+    canonical word codes that occur and the array of their counts.
+    All gaps are counted in one sweep over the sequences (see gapped_word_blocks).
+    """
+    nwords = 4**(2*halflength)#number of words of one gap
+    gaps = arange(ming, maxg+1)
+    dense = is_dense(halflength, ming, maxg)
+    tables = []
+    total = zeros(len(gaps)*nwords*dense, dtype=int64)
+    for words in gapped_word_blocks(packed, halflength, ming, maxg, blocksize):
+        if dense:
+            total += bincount(words, minlength=len(total))
+        else:
+            tables.append(unique(words, return_counts=True))
+    if dense:
+        words = nonzero(total)[0]
+        counts = total[words]
+    else:
+        words, counts = merge_word_counts(tables)
+    gapped_counts = {}#each key is the gap length
+    for j, g in enumerate(gaps):
+        lo, hi = words.searchsorted([j*nwords, (j+1)*nwords])
+        gapped_counts[g] = (words[lo:hi] - j*nwords, counts[lo:hi])
+    return gapped_counts
+
+def merge_word_counts(tables):
+    """ Merges (words, counts) tables into one, adding up the counts of words that are in several.
+    """
+    if len(tables) == 0:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    if len(tables) == 1:
+        return tables[0]
+    words, index = unique(concatenate([t[0] for t in tables]), return_inverse=True)
+    counts = bincount(index, weights=concatenate([t[1] for t in tables]), minlength=len(words))
+    return words, counts.astype(int64)
+
+def merge_gapped_counts(gapped_tables):
+    """ Merges the per gap count tables of several sets of sequences (see count_words_packed).
+    Merging is associative, so shards can be merged in any grouping.
+    """
+    merged = {}
+    for g in gapped_tables[0]:
+        merged[g] = merge_word_counts([t[g] for t in gapped_tables])
+    return merged
+
+#The sequences and arguments of a sharded count. Set before the pool is made, so the forked
+#processes inherit them instead of receiving a pickled copy of the sequences
+_count_run = {}
+
+def get_shards(packed, nshards):
+    """ Splits packed sequences into at most nshards (first, last+1) ranges of sequences
+    with about the same number of bps.
+    """
+    nseqs = packed.getNumSeqs()
+    cuts = packed.offsets.searchsorted(linspace(0, packed.getLen(), nshards+1)[1:-1])
+    cuts = unique(concatenate(([0], cuts.clip(1, max(1, nseqs-1)), [nseqs])))
+    return zip(cuts[:-1], cuts[1:])
+
+def get_shard(packed, bounds):
+    i, j = bounds
+    return sequence.PackedSequences(codes=packed.codes[packed.offsets[i]:packed.offsets[j]], offsets=packed.offsets[i:j+1]-packed.offsets[i])
+
+def count_shard(bounds):
+    """ Counts the words of sequences bounds[0] to bounds[1]-1 in _count_run.
+    """
+    return count_words_packed(get_shard(_count_run['packed'], bounds), *_count_run['args'])
+
+def count_words(packed, halflength, ming, maxg, procs=1):
+    """ Counts the gapped words in packed sequences, like count_words_packed.
+    With procs > 1, the sequences are split into shards of about the same number of bps
+    that are counted on procs processes, and the shard tables are merged.
+    """
+    print "Looking for k-mers of gaps", ming, "to", maxg
+    nseqs = packed.getNumSeqs()
+    if procs <= 1 or nseqs < 2:
+        return count_words_packed(packed, halflength, ming, maxg)
+    from multiprocessing import Pool
+    shards = get_shards(packed, 4*procs)#a few shards per process evens out the load
+    _count_run['packed'] = packed
+    _count_run['args'] = (halflength, ming, maxg)
+    pool = Pool(procs)
+    tables = pool.map(count_shard, shards)
+    pool.close()
+    pool.join()
+    return merge_gapped_counts(tables)
+
+def packed_key(packed):
+    """ SHA-1 of packed sequences, used to know whether saved counts are of the same sequences.
+    """
+    import hashlib
+    h = hashlib.sha1(packed.offsets.astype(int64).tostring())
+    h.update(packed.codes)
+    return h.hexdigest()
+
+def save_counts(filename, gapped_counts, halflength, key):
+    """ Saves count tables (see count_words_packed) of the packed sequences with the given key.
+    """
+    arrays = {'halflength': halflength, 'key': key}
+    for g in gapped_counts:
+        arrays['words%d' % g], arrays['counts%d' % g] = gapped_counts[g]
+    with open(filename, 'wb') as fh:
+        savez(fh, **arrays)
+
+def load_counts(filename, halflength, ming, maxg, key):
+    """ Loads count tables saved by save_counts. Returns None if they are not of the sequences
+    with the given key, were counted with another half-site length, or miss some of the gaps.
+    """
+    saved = load(filename)
+    if str(saved['key']) != key or int(saved['halflength']) != halflength:
+        return None
+    gapped_counts = {}
+    for g in range(ming,maxg+1):
+        if 'words%d' % g not in saved.files:
+            return None
+        gapped_counts[g] = (saved['words%d' % g], saved['counts%d' % g])
+    return gapped_counts
+
+def get_word_counts(packed, halflength, ming, maxg, procs=1, countsfile=None):
+    """ Counts the gapped words in packed sequences (see count_words).
+    If countsfile is given, the counts are loaded from it when it has counts of the same
+    sequences, and saved to it otherwise.
+    """
+    import os
+    if countsfile is not None:
+        key = packed_key(packed)
+        if os.path.isfile(countsfile):
+            gapped_counts = load_counts(countsfile, halflength, ming, maxg, key)
+            if gapped_counts is not None:
+                print 'Using the word counts in', countsfile
+                return gapped_counts
+            print 'The word counts in', countsfile, 'do not match, counting again'
+    gapped_counts = count_words(packed, halflength, ming, maxg, procs)
+    if countsfile is not None:
+        save_counts(countsfile, gapped_counts, halflength, key)
+    return gapped_counts
+
+def word_codes_to_strings(words, halflength, g):
+    """ The gapped words (as in the .words file) of an array of word codes.
+    """
+    strings = []
+    for word in words:
+        letters = []
+        for j in range(2*halflength):
+            letters.append("ACGT"[word%4])
+            word /= 4
+        letters.reverse()
+        strings.append(''.join(letters[:halflength]) + g*"N" + ''.join(letters[halflength:]))
+    return strings
+
+def get_zscores_packed(pos_counts, neg_counts):
+    """ Z-scores of the words counted in the positive sequences, for each gap.
+    Returns the z-scores and the negative counts of those words, both aligned with
+    the positive word arrays. Words that are missing in the negative sequences count as
+    1 in the z-score, and as 0 in the negative counts.
+    """
+    zscores = {}
+    neg_sites = {}
+    for g in pos_counts:
+        pos_words, p = pos_counts[g]
+        neg_words, n = neg_counts[g]
+        index = neg_words.searchsorted(pos_words)
+        found = zeros(len(pos_words), dtype=bool)
+        if len(neg_words) > 0:
+            index = minimum(index, len(neg_words)-1)
+            found = neg_words[index] == pos_words
+            n = where(found, n[index], 0)
+        else:
+            n = zeros(len(pos_words), dtype=int64)
+        neg_sites[g] = n
+        n = where(found, n, 1)
+        zscores[g] = 1.0*(p - n)/sqrt(n)
+    return zscores, neg_sites
+
+"""
+Bounded-memory counting. Instead of keeping the count tables of all words, every block of gapped
+words (see gapped_word_blocks) is tallied and spilled to disk, split into buckets by a hash of the
+word. A word is in the same bucket in the positive and the negative spill, so the buckets can be
+read back one at a time: each holds the exact counts and z-scores of its words. The standard
+deviation of the z-scores is accumulated over all buckets, and only the words that reach minsites
+are kept, so memory is set by the block and bucket sizes rather than by the size of the word space.
+"""
+def word_buckets(words, nbuckets):
+    """ Bucket of every word code, from a multiplicative hash.
+    """
+    return (words.astype(uint64)*uint64(11400714819323198485) >> uint64(32)) % uint64(nbuckets)
+
+def spill_word_counts(packed, halflength, ming, maxg, prefix, nbuckets, blocksize):
+    """ Tallies the gapped words of packed sequences a block at a time, and appends each block's
+    (word, count) pairs to the file prefix_b of their bucket b.
+    """
+    for words in gapped_word_blocks(packed, halflength, ming, maxg, blocksize):
+        words, counts = unique(words, return_counts=True)
+        buckets = word_buckets(words, nbuckets)
+        order = argsort(buckets, kind='mergesort')
+        bounds = buckets[order].searchsorted(arange(nbuckets+1))
+        for b in range(nbuckets):
+            pairs = order[bounds[b]:bounds[b+1]]
+            if len(pairs) > 0:
+                with open(prefix + "_" + str(b), 'ab') as fh:
+                    column_stack((words[pairs], counts[pairs])).astype(int64).tofile(fh)
+
+def spill_shard(bounds):
+    """ Spills the word counts of sequences bounds[0] to bounds[1]-1 in _count_run.
+    """
+    prefix = _count_run['prefix'] + str(bounds[0])
+    spill_word_counts(get_shard(_count_run['packed'], bounds), *(_count_run['args'] + (prefix,) + _count_run['spill']))
+    return prefix
+
+def spill_words(packed, halflength, ming, maxg, prefix, nbuckets, blocksize, procs=1):
+    """ Spills the word counts of packed sequences (see spill_word_counts), on procs processes.
+    Returns the prefixes of the spill files.
+    """
+    print "Looking for k-mers of gaps", ming, "to", maxg
+    if procs <= 1 or packed.getNumSeqs() < 2:
+        spill_word_counts(packed, halflength, ming, maxg, prefix, nbuckets, blocksize)
+        return [prefix]
+    from multiprocessing import Pool
+    _count_run['packed'] = packed
+    _count_run['args'] = (halflength, ming, maxg)
+    _count_run['prefix'] = prefix
+    _count_run['spill'] = (nbuckets, blocksize)
+    pool = Pool(procs)
+    prefixes = pool.map(spill_shard, get_shards(packed, 4*procs))
+    pool.close()
+    pool.join()
+    return prefixes
+
+def read_bucket(prefixes, b):
+    """ The sorted words of bucket b in the spill files, and their total counts.
+    """
+    import os
+    pairs = [fromfile(p + "_" + str(b), dtype=int64) for p in prefixes if os.path.isfile(p + "_" + str(b))]
+    pairs = concatenate(pairs + [zeros(0, dtype=int64)]).reshape(-1, 2)
+    words, index = unique(pairs[:,0], return_inverse=True)
+    counts = bincount(index, weights=pairs[:,1], minlength=len(words)).astype(int64)
+    return words, counts
+
+def get_zscores_bounded(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, maxmem, procs=1):
+    """ Z-scores of the words of the positive sequences with at least minsites sites, using about
+    maxmem bytes for counting. Returns what find_kmers needs: the positive counts, z-scores and
+    negative counts of those words for each gap (like get_zscores_packed), and the standard deviation
+    of the z-scores of all words of each gap. For each gap, the word with fewer than minsites sites
+    that has the highest z-score is kept as well, where the words written by find_kmers stop.
+    """
+    import tempfile, shutil
+    gaps = arange(ming, maxg+1)
+    nwords = 4**(2*halflength)
+    #spilled and merged (word, count) pairs take 16 bytes, and sorting them needs a few times that.
+    #A position of a block takes about 100 bytes per gap
+    bps = max(pos_seqs.getLen(), neg_seqs.getLen())
+    nbuckets = int(min(1000, max(1, ceil(4*16.0*len(gaps)*bps/maxmem))))
+    blocksize = int(max(1000, maxmem/(100*max(1, len(gaps)))))
+    print 'Counting in', nbuckets, 'buckets of', blocksize, 'positions per block'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        import os
+        print 'Counting words in positive sequences...'
+        pos_prefixes = spill_words(pos_seqs, halflength, ming, maxg, os.path.join(tmpdir, "pos"), nbuckets, blocksize, procs)
+        print 'Counting words in negative sequences...'
+        neg_prefixes = spill_words(neg_seqs, halflength, ming, maxg, os.path.join(tmpdir, "neg"), nbuckets, blocksize, procs)
+        print 'Calculating z-scores...'
+        kept = []
+        n = zeros(len(gaps))#number, mean and sum of squared deviations of the z-scores of each gap
+        mean = zeros(len(gaps))
+        m2 = zeros(len(gaps))
+        stop = [None]*len(gaps)#(z-score, word, count, negative count) where each gap stops
+        for b in range(nbuckets):
+            pos_words, pos_counts = read_bucket(pos_prefixes, b)
+            neg_words, neg_counts = read_bucket(neg_prefixes, b)
+            zscores, neg_sites = get_zscores_packed({0: (pos_words, pos_counts)}, {0: (neg_words, neg_counts)})
+            zscores = zscores[0]
+            neg_sites = neg_sites[0]
+            gapindex = pos_words/nwords
+            #combine the mean and variance of this bucket with those of the previous ones
+            nb = bincount(gapindex, minlength=len(gaps)).astype(float64)
+            meanb = bincount(gapindex, weights=zscores, minlength=len(gaps))/maximum(nb, 1)
+            m2b = bincount(gapindex, weights=(zscores - meanb[gapindex])**2, minlength=len(gaps))
+            total = maximum(n + nb, 1)
+            m2 += m2b + (meanb - mean)**2*n*nb/total
+            mean += (meanb - mean)*nb/total
+            n += nb
+            few = nonzero(pos_counts < minsites)[0]
+            few = few[lexsort((pos_words[few], -zscores[few]))]
+            for i in few[unique(gapindex[few], return_index=True)[1]]:#the best of each gap
+                j = gapindex[i]
+                if stop[j] is None or (-zscores[i], pos_words[i]) < (-stop[j][0], stop[j][1]):
+                    stop[j] = (zscores[i], pos_words[i], pos_counts[i], neg_sites[i])
+            many = pos_counts >= minsites
+            kept.append((pos_words[many], pos_counts[many], zscores[many], neg_sites[many]))
+    finally:
+        shutil.rmtree(tmpdir)
+    words, counts, zscores, neg_sites = [concatenate([k[c] for k in kept]) for c in range(4)]
+    pos_seq_counts = {}
+    gapped_zscores = {}
+    gapped_neg_sites = {}
+    z_stds = {}
+    for j, g in enumerate(gaps):
+        ingap = words/nwords == j
+        extra = [stop[j]] if stop[j] is not None else []
+        pos_seq_counts[g] = (concatenate((words[ingap], [s[1] for s in extra])).astype(int64) - j*nwords, concatenate((counts[ingap], [s[2] for s in extra])).astype(int64))
+        gapped_zscores[g] = concatenate((zscores[ingap], [s[0] for s in extra]))
+        gapped_neg_sites[g] = concatenate((neg_sites[ingap], [s[3] for s in extra])).astype(int64)
+        z_stds[g] = sqrt(m2[j]/n[j]) if n[j] > 0 else float64(nan)
+    return pos_seq_counts, gapped_zscores, gapped_neg_sites, z_stds
+
+def select_kmers(words, counts, zscores, z_std, minsites, zthresh):
+    """ The words to write, in order from the largest to the smallest z-score (equal z-scores in the
+    order of the word codes, which is the alphabetical order of the words). Words are written until
+    the first one whose corrected z-score is below zthresh or that has fewer than minsites sites.
+    Only the words above the threshold are sorted, the others are left out with one pass.
+    Returns the indices of the words to write, and whether a word stopped the list.
+    """
+    above = nonzero(~(zscores/z_std < zthresh))[0]
+    above = above[lexsort((words[above], -zscores[above]))]
+    few = nonzero(counts[above] < minsites)[0]
+    if len(few) > 0:
+        return above[:few[0]], True
+    return above, len(above) < len(words)
+
+"""
+Expected word counts from a first order Markov model of the positive sequences, instead of counts
+in a shuffled negative set. The model is fitted on the dinucleotides of the positive sequences,
+which is what a dinucleotide shuffle preserves. For a word made of half-sites L and R with gap g,
+P(word) = P(L) * P(first letter of R, g+1 letters after the last letter of L) * P(R | its first letter),
+and the expected count of a canonical word is the number of positions where words were counted
+times the probability of the word or of its reverse complement.
+"""
+def fit_markov(packed, pseudocounts=1.0):
+    """ Letter frequencies and the transition matrix of a first order Markov model of packed
+    sequences. Dinucleotides with an N or across two sequences are left out.
+    """
+    first = packed.codes[:-1].astype(intp)
+    second = packed.codes[1:].astype(intp)
+    valid = (first < 4) & (second < 4)
+    valid[packed.offsets[1:-1]-1] = False
+    transitions = bincount(first[valid]*4 + second[valid], minlength=16).reshape(4,4) + pseudocounts
+    transitions = transitions/transitions.sum(axis=1)[:,newaxis]
+    letters = packed.getLetterCounts()[:4] + pseudocounts
+    return letters/letters.sum(), transitions
+
+def get_expected_counts(pos_counts, halflength, letters, transitions):
+    """ Expected counts of the words counted in the positive sequences (see count_words_packed)
+    under a first order Markov model (see fit_markov), aligned with the positive word arrays.
+    """
+    shift = 4**halflength
+    digits = arange(shift)[:,newaxis]/4**arange(halflength-1, -1, -1)%4
+    inner = transitions[digits[:,:-1], digits[:,1:]].prod(axis=1)#P(half-site | its first letter)
+    firsts = digits[:,0]
+    lasts = digits[:,-1]
+    rc = get_rc_codes(halflength)
+    expected = {}
+    for g in pos_counts:
+        words, counts = pos_counts[g]
+        between = linalg.matrix_power(transitions, g+1)
+        def word_probs(left, right):
+            return letters[firsts[left]]*inner[left]*between[lasts[left], firsts[right]]*inner[right]
+        left = words/shift
+        right = words%shift
+        probs = word_probs(left, right)
+        rcleft = rc[right]
+        rcright = rc[left]
+        palindromes = (rcleft == left) & (rcright == right)
+        probs += where(palindromes, 0, word_probs(rcleft, rcright))
+        expected[g] = counts.sum()*probs
+    return expected
+
+def get_zscores_markov(pos_counts, expected):
+    """ Z-scores of the words counted in the positive sequences against their expected counts.
+    Expected counts below 1 count as 1, like words that are missing from a negative set.
+    """
+    zscores = {}
+    for g in pos_counts:
+        p = pos_counts[g][1]
+        n = maximum(expected[g], 1.0)
+        zscores[g] = 1.0*(p - n)/sqrt(n)
+    return zscores
+
+def find_kmers(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, zthresh, outputfile, procs=1, poscountsfile=None, negcountsfile=None, maxmem=0):
+    #pos_seqs and neg_seqs are PackedSequences, or lists of strings.
+    #If neg_seqs is None, expected counts from a Markov model of pos_seqs are used instead.
+    #Returns the k-mers as (word, sites, negative sites, corrected z-score, z-score) tuples, the columns
+    #of the output file. If outputfile is None, they are only returned
+    if not isinstance(pos_seqs, sequence.PackedSequences):
+        pos_seqs = sequence.PackedSequences(pos_seqs)
+    if neg_seqs is not None and not isinstance(neg_seqs, sequence.PackedSequences):
+        neg_seqs = sequence.PackedSequences(neg_seqs)
+    if neg_seqs is None:
+        print 'Counting words in positive sequences...'
+        pos_seq_counts = get_word_counts(pos_seqs, halflength, ming, maxg, procs, poscountsfile)
+        print 'Calculating expected counts from a Markov model of the positive sequences...'
+        letters, transitions = fit_markov(pos_seqs)
+        neg_sites = get_expected_counts(pos_seq_counts, halflength, letters, transitions)
+        print 'Calculating z-scores...'
+        zscores = get_zscores_markov(pos_seq_counts, neg_sites)
+        z_stds = {}
+        for g in zscores:
+            z_stds[g] = std(zscores[g])
+    elif maxmem > 0 and not is_dense(halflength, ming, maxg):
+        pos_seq_counts, zscores, neg_sites, z_stds = get_zscores_bounded(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, maxmem, procs)
+    else:
+        print 'Counting words in positive sequences...'
+        pos_seq_counts = get_word_counts(pos_seqs, halflength, ming, maxg, procs, poscountsfile)
+        print 'Counting words in negative sequences...' 
+        neg_seq_counts = get_word_counts(neg_seqs, halflength, ming, maxg, procs, negcountsfile)
+        print 'Calculating z-scores...'
+        zscores, neg_sites = get_zscores_packed(pos_seq_counts,neg_seq_counts)
+        z_stds = {}
+        for g in zscores:
+            z_stds[g] = std(zscores[g])
+    kmers = []
     """
     for g in range(ming,maxg+1):
         subplot(len(range(ming,maxg+1)),1,g+1)
         hist(zscores[g].values(),100,range=(-50,50))
     show()    
     """
-    print 'Writing to results to', outputfile
+    if outputfile is not None:
+        output = open(outputfile,'w')
+        print 'Writing to results to', outputfile
     for g in range(ming,maxg+1):
-        numkmers = len(sorted_keys[g])
-        z_std = std(zscores[g].values())
+        z_std = z_stds[g]
         print "Writing k-mers with gap", g
         print "Gap", g, "has standard deviation z-score of", z_std
-        for k in range(numkmers):#Keep iterating thru k-mers until z-scores below threshold
-            key = sorted_keys[g][k]
-            zscore = zscores[g][key]
+        words, counts = pos_seq_counts[g]
+        selected, stop = select_kmers(words, counts, zscores[g], z_std, minsites, zthresh)
+        for i in selected:
+            key = word_codes_to_strings([int(words[i])], halflength, g)[0]
+            zscore = zscores[g][i]
             corrected_zscore = zscore/z_std
-            if corrected_zscore < zthresh or pos_seq_counts[g][key] < minsites:
-                print "Gap", g, "had", k, "k-mers above the threshold that are above the minimum number of sites"
-                break
-            pos_sites = pos_seq_counts[g][key]
-            if neg_seq_counts[g].has_key(key):
-                neg_sites = neg_seq_counts[g][key]
+            pos_sites = int(counts[i])
+            if neg_seqs is None:#expected count
+                neg_count = "%.2f" % neg_sites[g][i]
             else:
-                neg_sites = 0
-            output.write(str(key)+"\t"+str(pos_sites)+"\t"+str(neg_sites)+"\t"+str(corrected_zscore)+"\t"+str(zscore)+"\n")
-    output.close()
+                neg_count = str(int(neg_sites[g][i]))
+            kmers.append((key, pos_sites, neg_count, corrected_zscore, zscore))
+            if outputfile is not None:
+                output.write(str(key)+"\t"+str(pos_sites)+"\t"+neg_count+"\t"+str(corrected_zscore)+"\t"+str(zscore)+"\n")
+        if stop:
+            print "Gap", g, "had", len(selected), "k-mers above the threshold that are above the minimum number of sites"
+    if outputfile is not None:
+        output.close()
+    return kmers
 
 """
 The main executable function
@@ -103,7 +522,7 @@ def main():
     description = "The program performs a DREME-like search for gapped k-mers"
     parser = ArgumentParser(description=description)
     parser.add_argument('fastafile', metavar='f', help='FASTA file containing the sequences')
-    parser.add_argument('negativefile', metavar='n', help='FASTA file containing the negative sequences')
+    parser.add_argument('negativefile', metavar='n', help='FASTA file containing the negative sequences, or markov to compare with the expected counts of a first order Markov model of the sequences instead')
     parser.add_argument('outputfile', metavar='o', help='Output file')
     parser.add_argument("-w", "--width", dest="width", help="Width of the motif to search for. This makes the program only search for a motif of this width. Beware if greater than 8", type=int, default=0)
     parser.add_argument("-ming", dest="mingap", help="Minimum gap of k-mer to search for. Default: 0", type=int, default=0)
@@ -115,19 +534,30 @@ def main():
     parser.add_argument("-maxk", dest="maxk", help="Maximum width of the core to search for. Default: 8", type=int, default=8)
     parser.add_argument("-z", "--zthresh", dest="zthresh", help="Corrected z-score threshold. Default: 5", type=float, default=5)
     parser.add_argument("-minsites", "--minsites", dest="minsites", help="Minimum number of sites for a k-mer to be included. Default: 10", type=int, default=10)    
+    parser.add_argument("-procs", "--procs", dest="procs", help="Number of processes to count words on. Default: 1", type=int, default=1)
+    parser.add_argument("-poscounts", "--poscounts", dest="poscounts", help="File of word counts of the positive sequences. The counts are read from it if it has counts of the same sequences, and written to it otherwise", default=None)
+    parser.add_argument("-negcounts", "--negcounts", dest="negcounts", help="File of word counts of the negative sequences, like -poscounts", default=None)
+    parser.add_argument("-maxmem", "--maxmem", dest="maxmem", help="Memory in MB to count words with when -l is too long to count them in memory. Counts are spilled to temporary files instead. Cannot be combined with -poscounts or -negcounts. Default: 0 (no limit)", type=float, default=0)
     args = parser.parse_args()
+    if args.maxmem > 0 and (args.poscounts is not None or args.negcounts is not None):
+        parser.error("-maxmem does not keep the word counts, so it cannot be combined with -poscounts or -negcounts")
+    if args.negativefile == 'markov' and (args.maxmem > 0 or args.negcounts is not None):
+        parser.error("-maxmem and -negcounts need negative sequences, they cannot be used with markov")
     pos_seq_file_name = args.fastafile
     neg_seq_file_name = args.negativefile
     print 'Reading positive sequence file...'    
-    pos_seqs = sequence.convert_ambigs(sequence.readFASTA(pos_seq_file_name, None, True))
-    print 'Reading negative sequence file...'
-    neg_seqs = sequence.convert_ambigs(sequence.readFASTA(neg_seq_file_name, None, True))
+    pos_seqs = sequence.readPackedFASTA(pos_seq_file_name)
+    if neg_seq_file_name == 'markov':
+        neg_seqs = None
+    else:
+        print 'Reading negative sequence file...'
+        neg_seqs = sequence.readPackedFASTA(neg_seq_file_name)
     halflength = args.halflength
     ming = args.mingap
     maxg = args.maxgap
     zthresh = args.zthresh
     minsites = args.minsites
-    find_kmers(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, zthresh, args.outputfile)
+    find_kmers(pos_seqs, neg_seqs, halflength, ming, maxg, minsites, zthresh, args.outputfile, args.procs, args.poscounts, args.negcounts, args.maxmem*2**20)
 
 if __name__=='__main__':
     main()
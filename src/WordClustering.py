@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import sys
+from numpy import *
+import WordSimilarity
+
+def get_distances(sims, missing_penalty=1.0):
+    """ Distances between words for the clustering, from their similarities (see
+    WordSimilarity.word_similarities). Word pairs without a positive similarity get
+    missing_penalty, and words without any positive similarity are left out, like in
+    motif.jar. Returns the indices of the words that are kept and their distances.
+    """
+    positive = sims > 0
+    fill_diagonal(positive, False)
+    ids = nonzero(positive.any(axis=1))[0]
+    if len(ids) < len(sims):
+        sims = sims[ix_(ids,ids)]
+        positive = positive[ix_(ids,ids)]
+    distances = 1 - sims
+    putmask(distances, ~positive, missing_penalty)
+    return ids, distances
+
+"""
+Group average (UPGMA) hierarchical clustering with the nearest-neighbor chain algorithm, in
+O(n^2) time and memory. Clusters are merged as long as their average distance is at most
+threshold, which gives the same clusters as motif.jar's HierarchicalClustering (repeatedly
+merging the closest pair) up to ties, without rescanning all pairs after each merge.
+
+A chain is grown from any cluster by following nearest neighbors until two clusters are each
+other's nearest neighbors. They are merged, and the distances of the merged cluster are the
+size-weighted averages of the two rows (Lance-Williams). If the last cluster of the chain is
+farther than threshold from every cluster, no cluster of the chain can ever be merged again
+(an average is never below both of its terms), so they are all set aside.
+
+The distances are rounded to 12 decimals first, so that distances that should be equal but
+differ in their last bits (as they are summed in different orders) are ties, whether they were
+read from text or from a binary file.
+
+Input:
+distances, symmetric (n x n) array of distances. It is overwritten
+threshold, the largest average distance at which two clusters are merged
+
+Output:
+list of clusters, each a list of row indices. As in motif.jar, a merged cluster lists the
+members of the cluster with the smallest index first, and clusters are ordered by their
+smallest index
+"""
+def average_linkage(distances, threshold):
+    n = len(distances)
+    around(distances, 12, out=distances)
+    fill_diagonal(distances, inf)
+    members = [[i] for i in range(n)]
+    sizes = ones(n)
+    done = zeros(n, dtype=bool)#merged into another cluster or set aside
+    chain = []
+    start = 0
+    while True:
+        if not chain:
+            while start < n and done[start]:
+                start += 1
+            if start == n:
+                break
+            chain.append(start)
+        a = chain[-1]
+        row = distances[a]
+        b = row.argmin()
+        if len(chain) > 1 and row[chain[-2]] <= row[b]:#prefer the previous cluster on ties
+            b = chain[-2]
+        if row[b] > threshold:
+            for c in chain:
+                done[c] = True
+                distances[c,:] = inf
+                distances[:,c] = inf
+            chain = []
+        elif len(chain) > 1 and b == chain[-2]:
+            chain = chain[:-2]
+            keep, drop = min(a,b), max(a,b)
+            merged = (sizes[keep]*distances[keep] + sizes[drop]*distances[drop])/(sizes[keep]+sizes[drop])
+            distances[keep,:] = merged
+            distances[:,keep] = merged
+            distances[keep,keep] = inf
+            distances[drop,:] = inf
+            distances[:,drop] = inf
+            sizes[keep] += sizes[drop]
+            members[keep] += members[drop]
+            members[drop] = []
+            done[drop] = True
+        else:
+            chain.append(b)
+    return [m for m in members if m]
+
+def cluster_words(sims, threshold, missing_penalty=1.0):
+    """ Clusters words by the similarities of their PWMs (see WordSimilarity.word_similarities).
+    Returns the clusters as lists of word indices (see average_linkage). Words without any
+    positive similarity are not in any cluster.
+    """
+    ids, distances = get_distances(sims, missing_penalty)
+    return [ids[c].tolist() for c in average_linkage(distances, threshold)]
+
+def read_distances(filename, missing_penalty=1.0):
+    """ Reads a .wm.dist file (see WordSimilarity.write_distances). Returns the word indices
+    in the file and their distances.
+    """
+    pairs = [line.split()[:3] for line in open(filename) if line.strip()]
+    rows = array([int(p[0]) for p in pairs], dtype=int)
+    cols = array([int(p[1]) for p in pairs], dtype=int)
+    ids, positions = unique(concatenate((rows, cols)), return_inverse=True)
+    distances = empty((len(ids),len(ids)))
+    distances.fill(missing_penalty)
+    rows, cols = positions[:len(pairs)], positions[len(pairs):]
+    distances[rows,cols] = distances[cols,rows] = [float(p[2]) for p in pairs]
+    return ids, distances
+
+def write_clusters(output, clusters):
+    """ Writes clusters in the output format of motif.jar's HierarchicalClustering
+    """
+    for k, cluster in enumerate(clusters):
+        output.write(">cluster"+str(k)+"\t"+str(len(cluster))+"\n")
+        for i in cluster:
+            output.write(str(i)+"\n")
+        output.write("\n")
+
+"""
+The main executable function
+"""
+def main():
+    usage = "usage: %prog [options] <distance file> <threshold> <missing penalty>"
+    description = "Group average hierarchical clustering of words. Reads the distances written by WordSimilarity.py (text, or the binary file of -binary) and writes the clusters to standard output"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('distfile', metavar='d', help='Distance file from WordSimilarity.py, or its binary (.npz) file')
+    parser.add_argument('threshold', metavar='t', help='Largest average distance at which two clusters are merged', type=float)
+    parser.add_argument('missing_penalty', metavar='m', help='Distance of the word pairs that are not in the distance file (no positive similarity)', type=float)
+    args = parser.parse_args()
+    if args.distfile.endswith('.npz'):
+        words, sims, strands, offsets = WordSimilarity.load_similarities(args.distfile)
+        clusters = cluster_words(sims, args.threshold, args.missing_penalty)
+    else:
+        ids, distances = read_distances(args.distfile, args.missing_penalty)
+        clusters = [ids[c].tolist() for c in average_linkage(distances, args.threshold)]
+    write_clusters(sys.stdout, clusters)
+
+if __name__=='__main__':
+    main()
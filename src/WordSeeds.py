@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from collections import OrderedDict
+import sequence
+import GappedKmerSearch
+import WordSimilarity
+import WordClustering
+import Consensus2PWM
+
+def read_kmers(filename):
+    """ Reads a words file written by GappedKmerSearch.py as the k-mers of find_kmers
+    """
+    kmers = []
+    for line in open(filename):
+        p = line.split()
+        if p:
+            kmers.append((p[0], int(p[1]), p[2], float(p[3]), float(p[4])))
+    return kmers
+
+"""
+Aligns the words of a cluster, the same as align_sequence_in_cluster.pl. Each word
+is aligned to the closest word before it in the cluster that has a positive similarity
+with it, at the offset and strand of their best similarity. A word that does not have a
+positive similarity with any word before it (align_sequence_in_cluster.pl stops there)
+is put at the start of the alignment, on the forward strand.
+
+Input:
+cluster, list of word indices
+words, list of all words
+strands, offsets, sims, similarities of all words (see WordSimilarity.word_similarities)
+
+Output:
+list of the words of the cluster, reverse complemented if they align on the reverse strand,
+and padded on the left with '.' to their place in the alignment
+"""
+def align_cluster(cluster, words, strands, offsets, sims):
+    seqs = [words[i] for i in cluster]
+    spaces = [0]*len(cluster)
+    dirs = ['+']*len(cluster)
+    for j in range(1, len(cluster)):
+        b = cluster[j]
+        k = j-1
+        while k >= 0 and not sims[cluster[k],b] > 0:
+            k -= 1
+        if k < 0:
+            continue
+        a = cluster[k]
+        lenA, lenB = len(words[a]), len(words[b])
+        if a < b:
+            pos, forward = int(offsets[a,b]), strands[a,b]
+            alignForward, alignPos = forward, pos
+            if dirs[k] == '-':
+                alignForward = not forward
+                alignPos = lenA - pos - lenB
+        else:
+            pos, forward = int(offsets[b,a]), strands[b,a]
+            alignForward = forward
+            if dirs[k] == '+':
+                alignPos = -pos if forward else -(lenB - pos - lenA)
+            else:
+                #word A is already reverse complemented
+                alignForward = not forward
+                alignPos = -(lenB - pos - lenA) if forward else -pos
+        if not alignForward:
+            seqs[j] = GappedKmerSearch.get_rc(seqs[j])
+            dirs[j] = '-'
+        alignPos += spaces[k]
+        if alignPos > 0:
+            spaces[j] += alignPos
+        elif alignPos < 0:
+            #add space before all previous words
+            for i in range(j):
+                spaces[i] -= alignPos
+    return ['.'*space + seq for space, seq in zip(spaces, seqs)]
+
+"""
+Turns the k-mers found by GappedKmerSearch.find_kmers into seed PWMs, without any
+intermediate files. The words are compared (WordSimilarity), clustered (WordClustering),
+aligned within their clusters (align_cluster) and made into PWMs weighted by their
+corrected z-scores (Consensus2PWM), which is what run_consensus_clusering_using_wm.pl
+followed by Consensus2PWM.py does.
+
+Input:
+kmers, list of (word, sites, negative sites, corrected z-score, z-score) from find_kmers
+threshold, largest average distance (1 - similarity) at which two clusters are merged
+missing_penalty, distance of the word pairs without a positive similarity
+
+Output:
+PWM_dict, ordered dictionary from the cluster names (cluster1, cluster2...), largest
+cluster first, to their PWMs and consensus sequences, as in Consensus2PWM.get_PWM_dictionary
+"""
+def get_seeds(kmers, threshold, missing_penalty=1.0):
+    PWM_dict = OrderedDict()
+    if not kmers:
+        return PWM_dict
+    words = [kmer[0].upper() for kmer in kmers]
+    sims, strands, offsets = WordSimilarity.word_similarities(words)
+    clusters = WordClustering.cluster_words(sims, threshold, missing_penalty)
+    #largest clusters first, ties in clustering order, like update_java_out_cluster.pl
+    clusters.sort(key=len, reverse=True)
+    for k, cluster in enumerate(clusters):
+        aligned_kmers = align_cluster(cluster, words, strands, offsets, sims)
+        zscores = [kmers[i][3] for i in cluster]
+        PWM_dict['cluster'+str(k+1)] = Consensus2PWM.get_aligned_PWM(aligned_kmers, zscores)
+    return PWM_dict
+
+"""
+The main executable function
+"""
+def main():
+    usage = "usage: %prog [options] <fasta file> <negative fasta file> <output file>"
+    description = "Finds gapped words like GappedKmerSearch.py and turns them into seed PWMs like run_consensus_clusering_using_wm.pl and Consensus2PWM.py, in one process and without intermediate files"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('fastafile', metavar='f', help='FASTA file containing the sequences')
+    parser.add_argument('negativefile', metavar='n', help='FASTA file containing the negative sequences, or markov to compare with the expected counts of a first order Markov model of the sequences instead')
+    parser.add_argument('outputfile', metavar='o', help='Output file for the seed PWMs')
+    parser.add_argument("-ming", dest="mingap", help="Minimum gap of k-mer to search for. Default: 0", type=int, default=0)
+    parser.add_argument("-maxg", dest="maxgap", help="Maximum gap of k-mer to search for. Default: 10", type=int, default=10)
+    parser.add_argument("-l", dest="halflength", help="Number of non-degenerate letters per half-site. Total number of non-degenerate letters is twice this number. Default: 4", type=int, default=4)
+    parser.add_argument("-z", "--zthresh", dest="zthresh", help="Corrected z-score threshold. Default: 5", type=float, default=5)
+    parser.add_argument("-minsites", "--minsites", dest="minsites", help="Minimum number of sites for a k-mer to be included. Default: 10", type=int, default=10)
+    parser.add_argument("-procs", "--procs", dest="procs", help="Number of processes to count words on. Default: 1", type=int, default=1)
+    parser.add_argument("-poscounts", "--poscounts", dest="poscounts", help="File of word counts of the positive sequences, as in GappedKmerSearch.py", default=None)
+    parser.add_argument("-negcounts", "--negcounts", dest="negcounts", help="File of word counts of the negative sequences, as in GappedKmerSearch.py", default=None)
+    parser.add_argument("-maxmem", "--maxmem", dest="maxmem", help="Memory in MB to count words with, as in GappedKmerSearch.py. Default: 0 (no limit)", type=float, default=0)
+    parser.add_argument("-threshold", "--threshold", dest="threshold", help="Largest average distance (1 - similarity) at which two clusters of words are merged, the THRESHOLD of run_consensus_clusering_using_wm.pl. Default: 0.3", type=float, default=0.3)
+    parser.add_argument("-binary", "--binary", dest="binary", help="Also write the seeds to this folder as a binary seed bundle, as in Consensus2PWM.py", default=None)
+    parser.add_argument("-words", "--words", dest="words", help="Also write the words to this file, in the format of GappedKmerSearch.py", default=None)
+    args = parser.parse_args()
+    if args.maxmem > 0 and (args.poscounts or args.negcounts):
+        parser.error("-maxmem does not keep the word counts, so it cannot be combined with -poscounts or -negcounts")
+    if args.negativefile == 'markov' and (args.maxmem > 0 or args.negcounts):
+        parser.error("-maxmem and -negcounts need negative sequences, they cannot be used with markov")
+    print 'Reading positive sequence file...'
+    pos_seqs = sequence.readPackedFASTA(args.fastafile)
+    if args.negativefile == 'markov':
+        neg_seqs = None
+    else:
+        print 'Reading negative sequence file...'
+        neg_seqs = sequence.readPackedFASTA(args.negativefile)
+    kmers = GappedKmerSearch.find_kmers(pos_seqs, neg_seqs, args.halflength, args.mingap, args.maxgap, args.minsites, args.zthresh, args.words, args.procs, args.poscounts, args.negcounts, args.maxmem*2**20)
+    print 'Clustering', len(kmers), 'words'
+    PWM_dict = get_seeds(kmers, args.threshold)
+    print 'Writing', len(PWM_dict), 'seeds to', args.outputfile
+    Consensus2PWM.write_PWMs(args.outputfile, PWM_dict)
+    if args.binary is not None:
+        Consensus2PWM.write_seed_bundle(args.binary, PWM_dict)
+
+if __name__=='__main__':
+    main()
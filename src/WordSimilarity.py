@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from numpy import *
+
+"""
+Letter probabilities of the consensus letters, the same as in consensus2weightmatrix.pl
+"""
+_letter_probs = {
+    'A' : (1, 0, 0, 0),
+    'C' : (0, 1, 0, 0),
+    'G' : (0, 0, 1, 0),
+    'T' : (0, 0, 0, 1),
+    'R' : (0.5, 0, 0.5, 0),
+    'Y' : (0, 0.5, 0, 0.5),
+    'K' : (0, 0, 0.5, 0.5),
+    'M' : (0.5, 0.5, 0, 0),
+    'S' : (0, 0.5, 0.5, 0),
+    'W' : (0.5, 0, 0, 0.5),
+    'N' : (0.25, 0.25, 0.25, 0.25)
+    }
+
+def get_letter_table():
+    """ Lookup table from the byte value of a consensus letter to the deviation of its PWM column
+    from the uniform background. The columns are made like consensus2weightmatrix.pl does, with
+    0.01 pseudocounts and 4 decimals. Bytes that are not consensus letters (the padding) get the
+    uniform column, that is no deviation.
+    """
+    table = zeros((256,4))
+    for letter in _letter_probs:
+        probs = (array(_letter_probs[letter])+0.01)/1.04
+        probs = around(probs/probs.sum(), 4)
+        table[ord(letter)] = probs/probs.sum() - 0.25
+    return table
+
+def read_words(filename):
+    """ The words (first column) of a words file written by GappedKmerSearch.py
+    """
+    words = []
+    for line in open(filename):
+        parts = line.split()
+        if parts:
+            words.append(parts[0].upper())
+    return words
+
+def get_deviations(words, width):
+    """ PWMs of words, as deviations from the uniform background, padded with uniform columns
+    to the same width. Returns the PWMs of the words and of their reverse complements, both
+    as arrays of shape (number of words, width, 4).
+    """
+    letters = array(words, dtype='S'+str(width)).view(uint8).reshape(len(words), width)
+    forward = get_letter_table()[letters]
+    #the reverse complement of a column is the column read backwards (ACGT -> TGCA)
+    lengths = array([len(w) for w in words])
+    columns = lengths[:,newaxis] - 1 - arange(width)
+    reverse = forward[arange(len(words))[:,newaxis], columns, ::-1]
+    reverse[columns < 0] = 0
+    return forward, reverse
+
+"""
+All-pairs similarity of the PWMs of words, the same measure as GenerateSimMatrixForNewFormatWM
+in motif.jar. Two PWMs are aligned at every offset, on both strands, and the Pearson correlation
+of their probabilities over the aligned columns is taken, with uniform columns where only one of
+them has a column. The similarity is the largest correlation. Since uniform columns do not
+deviate from the mean, the correlation at an offset is the dot product of the two deviation
+matrices at that offset, divided by both of their norms. For each offset, the dot products of a
+block of words with all words are one matrix product.
+
+Input:
+words, list of words (consensus strings)
+blocksize, number of words compared with all words at a time (default: 256)
+
+Output:
+sims, (number of words x number of words) array of similarities
+strands, for i < j, strands[i,j] is True if word j aligns to word i on the forward strand
+offsets, for i < j, offsets[i,j] is where the first letter of word j (or of its reverse
+complement) aligns in word i. Only meaningful when sims[i,j] > 0
+As in motif.jar, the reverse strand wins ties, and so does the smallest offset.
+"""
+def word_similarities(words, blocksize=256):
+    n = len(words)
+    width = max([len(w) for w in words])
+    forward, reverse = get_deviations(words, width)
+    norms = sqrt((forward**2).sum(axis=2).sum(axis=1))
+    forward = forward.reshape(n, width*4)
+    reverse = reverse.reshape(n, width*4)
+    sims = zeros((n,n))
+    strands = zeros((n,n), dtype=bool)
+    offsets = zeros((n,n), dtype=int16)
+    for lo in range(0, n, blocksize):
+        hi = min(lo+blocksize, n)
+        best = empty((hi-lo, n-lo))
+        best.fill(-inf)
+        best_strands = zeros((hi-lo, n-lo), dtype=bool)
+        best_offsets = zeros((hi-lo, n-lo), dtype=int16)
+        a = forward[lo:hi]
+        for strand, b in ((False, reverse[lo:]), (True, forward[lo:])):
+            for offset in range(1-width, width):
+                if offset >= 0:
+                    dots = dot(a[:,4*offset:], b[:,:4*(width-offset)].T)
+                else:
+                    dots = dot(a[:,:4*(width+offset)], b[:,-4*offset:].T)
+                #the norms are the same at every offset, so the dot products can be compared directly.
+                #Equal dot products can differ in the last bits, so ties are found with a tolerance
+                better = dots > best + 1e-9
+                putmask(best, better, dots)
+                putmask(best_strands, better, strand)
+                putmask(best_offsets, better, offset)
+        best /= norms[lo:hi,newaxis]*norms[newaxis,lo:]
+        #only the word pairs i < j are compared, like in motif.jar
+        block = triu(best[:,:hi-lo], 1)
+        sims[lo:hi,lo:hi] = block + block.T
+        sims[lo:hi,hi:] = best[:,hi-lo:]
+        sims[hi:,lo:hi] = best[:,hi-lo:].T
+        strands[lo:hi,lo:] = best_strands
+        offsets[lo:hi,lo:] = best_offsets
+    return sims, strands, offsets
+
+def save_similarities(filename, words, sims, strands, offsets):
+    """ Binary dump of the similarities of words (see word_similarities)
+    """
+    savez(filename, words=array(words), sims=sims, strands=strands, offsets=offsets)
+
+def load_similarities(filename):
+    """ Reads a dump written by save_similarities. Returns words, sims, strands and offsets
+    """
+    data = load(filename)
+    return list(data['words']), data['sims'], data['strands'], data['offsets']
+
+def write_distances(filename, sims, strands, offsets):
+    """ Writes the word pairs with a positive similarity in the .wm.dist format of
+    run_consensus_clusering_using_wm.pl: index of word A, index of word B, 1-similarity,
+    strand (+ or -) and offset of word B in word A
+    """
+    output = open(filename, 'w')
+    rows, cols = nonzero(triu(sims > 0, 1))
+    dists = (1-sims[rows,cols]).tolist()
+    signs = where(strands[rows,cols], '+', '-').tolist()
+    pairs = zip(rows.tolist(), cols.tolist(), dists, signs, offsets[rows,cols].tolist())
+    for start in range(0, len(pairs), 1<<16):
+        output.write("".join(["%d\t%d\t%.15g\t%s\t%d\n" % pair for pair in pairs[start:start+(1<<16)]]))
+    output.close()
+
+"""
+The main executable function
+"""
+def main():
+    usage = "usage: %prog [options] <words file> <distance file>"
+    description = "Computes the similarity of the PWMs of all pairs of words from GappedKmerSearch.py, over all offsets and both strands, and writes the pairs with a positive similarity as distances for the clustering"
+    parser = ArgumentParser(description=description)
+    parser.add_argument('wordsfile', metavar='w', help='Words file from GappedKmerSearch.py')
+    parser.add_argument('outputfile', metavar='o', help='Output file for the distances')
+    parser.add_argument("-binary", "--binary", dest="binary", help="Also save the similarities, strands and offsets of all pairs to this binary (.npz) file", default=None)
+    args = parser.parse_args()
+    words = read_words(args.wordsfile)
+    sims, strands, offsets = word_similarities(words)
+    write_distances(args.outputfile, sims, strands, offsets)
+    if args.binary is not None:
+        save_similarities(args.binary, words, sims, strands, offsets)
+
+if __name__=='__main__':
+    main()
@@ -1,7 +1,9 @@
 #!/data/apps/python/2.7.2/bin/python
 
-import sys, string, random
+import sys, string
 import sequence
+from numpy import frombuffer, uint8, unique, argsort, bincount, concatenate, cumsum, intp, arange, lexsort, array
+from numpy.random import RandomState
 
 # 
 # turn on psyco to speed up by 3X
@@ -20,125 +22,98 @@ if __name__=='__main__':
 
 # altschulEriksonDinuclShuffle.py
 # P. Clote, Oct 2003
-
-def computeCountAndLists(s):
-
-  #Initialize lists and mono- and dinucleotide dictionaries
-  List = {} #List is a dictionary of lists
-  List['A'] = []; List['C'] = [];
-  List['G'] = []; List['T'] = [];
-  # FIXME: is this ok?
-  List['N'] = []
-  nuclList   = ["A","C","G","T","N"]
-  s       = s.upper()
-  #s       = s.replace("U","T")
-  nuclCnt    = {}  #empty dictionary
-  dinuclCnt  = {}  #empty dictionary
-  for x in nuclList:
-    nuclCnt[x]=0
-    dinuclCnt[x]={}
-    for y in nuclList:
-      dinuclCnt[x][y]=0
-
-  #Compute count and lists
-  nuclCnt[s[0]] = 1
-  nuclTotal     = 1
-  dinuclTotal   = 0
-  for i in range(len(s)-1):
-    x = s[i]; y = s[i+1]
-    List[x].append( y )
-    nuclCnt[y] += 1; nuclTotal  += 1
-    dinuclCnt[x][y] += 1; dinuclTotal += 1
-  assert (nuclTotal==len(s))
-  assert (dinuclTotal==len(s)-1)
-  return nuclCnt,dinuclCnt,List
- 
- 
-def chooseEdge(x,dinuclCnt):
-  z = random.random()
-  denom=dinuclCnt[x]['A']+dinuclCnt[x]['C']+dinuclCnt[x]['G']+dinuclCnt[x]['T']+dinuclCnt[x]['N']
-  numerator = dinuclCnt[x]['A']
-  if z < float(numerator)/float(denom):
-    dinuclCnt[x]['A'] -= 1
-    return 'A'
-  numerator += dinuclCnt[x]['C']
-  if z < float(numerator)/float(denom):
-    dinuclCnt[x]['C'] -= 1
-    return 'C'
-  numerator += dinuclCnt[x]['G']
-  if z < float(numerator)/float(denom):
-    dinuclCnt[x]['G'] -= 1
-    return 'G'
-  numerator += dinuclCnt[x]['T']
-  if z < float(numerator)/float(denom):
-    dinuclCnt[x]['T'] -= 1
-    return 'T'
-  dinuclCnt[x]['N'] -= 1
-  return 'N'
-
-def connectedToLast(edgeList,nuclList,lastCh):
-  D = {}
-  for x in nuclList: D[x]=0
-  for edge in edgeList:
-    a = edge[0]; b = edge[1]
-    if b==lastCh: D[a]=1
-  for i in range(3):
-    for edge in edgeList:
-      a = edge[0]; b = edge[1]
-      if D[b]==1: D[a]=1
-  ok = 0
-  for x in nuclList:
-    if x!=lastCh and D[x]==0: return 0
-  return 1
-
-def eulerian(s):
-  nuclCnt,dinuclCnt,List = computeCountAndLists(s)
-  #compute nucleotides appearing in s
-  nuclList = []
-  for x in ["A","C","G","T","N"]:
-    if x in s: nuclList.append(x)
-  #create dinucleotide shuffle L 
-  firstCh = s[0]  #start with first letter of s
-  lastCh  = s[-1]
-  edgeList = []
-  for x in nuclList:
-    if x!= lastCh: edgeList.append( [x,chooseEdge(x,dinuclCnt)] )
-  ok = connectedToLast(edgeList,nuclList,lastCh)
-  return ok,edgeList,nuclList,lastCh
-
-
-def shuffleEdgeList(L):
-  n = len(L); barrier = n
-  for i in range(n-1):
-    z = int(random.random() * barrier)
-    tmp = L[z]
-    L[z]= L[barrier-1]
-    L[barrier-1] = tmp
-    barrier -= 1
-  return L
-
-def dinuclShuffle(s):
-  ok = 0
-  while not ok:
-    ok,edgeList,nuclList,lastCh = eulerian(s)
-  nuclCnt,dinuclCnt,List = computeCountAndLists(s)
-
-  #remove last edges from each vertex list, shuffle, then add back
-  #the removed edges at end of vertex lists.
-  for [x,y] in edgeList: List[x].remove(y)
-  for x in nuclList: shuffleEdgeList(List[x])
-  for [x,y] in edgeList: List[x].append(y)
-
-  #construct the eulerian path
-  L = [s[0]]; prevCh = s[0]
-  for i in range(len(s)-2):
-    ch = List[prevCh][0] 
-    L.append( ch )
-    del List[prevCh][0]
-    prevCh = ch
-  L.append(s[-1])
-  t = string.join(L,"")
-  return t
+#
+# The Altschul-Erikson shuffle on integer arrays. The letters of s are numbered, and the
+# edges (dinucleotides) are grouped by their first letter with one stable sort,
+# so the edge list of each letter is a slice of one array. Choosing the last
+# edge of each letter and shuffling the other edges are array operations on it.
+# Walking the Eulerian path is still a Python loop with one step per letter,
+# since each step depends on the letter before it, and it is most of the time
+# on long sequences. Any letters are allowed, not just ACGTN, and the
+# dinucleotide counts are preserved exactly.
+
+def vectorDinuclShuffle(s, rng):
+  s = s.upper()
+  n = len(s)
+  if n < 3: return s
+  letters, x = unique(frombuffer(s, dtype=uint8), return_inverse=True)
+  k = len(letters)
+  firstCh = x[0]; lastCh = x[-1]
+
+  #edge list of letter v is dst[start[v]:start[v+1]]
+  src = x[:-1]
+  order = argsort(src, kind='mergesort')
+  src = src[order]; dst = x[1:][order]
+  deg = bincount(src, minlength=k)
+  start = concatenate(([0], cumsum(deg)))
+
+  #choose a last edge for every letter but lastCh, until those edges form
+  #a tree that leads every letter to lastCh. Many tries are drawn at once,
+  #one per row, and the first one that forms a tree is used
+  notLast = arange(k) != lastCh
+  tries = 16
+  while True:
+    lastEdges = start[:-1] + (rng.random_sample((tries, k)) * deg).astype(intp)
+    nxt = dst[lastEdges.clip(0, n-2)]
+    nxt[:,lastCh] = lastCh
+    nxt += arange(tries)[:,None] * k  #so that every row indexes itself
+    reach = ~notLast[None,:].repeat(tries, 0)
+    for i in range(k): reach = reach | reach.ravel()[nxt]
+    good = reach.all(1).nonzero()[0]
+    if len(good) > 0: break
+  lastEdge = lastEdges[good[0]]
+
+  #shuffle each edge list, keeping the last edges at the end
+  keys = rng.random_sample(n-1)
+  keys[lastEdge[notLast]] = 2.0
+  dst = dst[lexsort((keys, src))].tolist()
+
+  #construct the eulerian path, one letter at a time on plain lists
+  ptr = start[:-1].tolist()
+  L = [firstCh]; prevCh = firstCh
+  for i in xrange(n-1):
+    e = ptr[prevCh]; ptr[prevCh] = e + 1
+    prevCh = dst[e]
+    L.append(prevCh)
+  return letters[array(L)].tostring()
+
+# Every copy of every sequence is shuffled with its own random stream, seeded
+# with (seed, sequence index, copy), so the output does not depend on the order
+# in which sequences are shuffled or on how many processes shuffle them.
+
+def shuffleRecord(record):
+  index, name, s, seed, copies, tag = record
+  out = []
+  for i in range(copies):
+    rng = RandomState([seed & 0xffffffff, index, i])
+    shuffledSeq = vectorDinuclShuffle(s, rng)
+    if (copies == 1):
+      out.append(">%s\n%s\n" % (name+tag, shuffledSeq))
+    else:
+      out.append(">%s_%d\n%s\n" % (name+tag, i, shuffledSeq))
+  return "".join(out)
+
+def shuffleRecords(records, procs, out, batchsize = 1 << 22):
+  # records are read and written a batch of about batchsize bps at a time,
+  # so memory stays bounded and the output is in input order
+  pool = None
+  if procs > 1:
+    from multiprocessing import Pool
+    pool = Pool(procs)
+  batch = []; batchLen = 0
+  records = iter(records)
+  while True:
+    record = next(records, None)
+    if record is not None:
+      batch.append(record); batchLen += len(record[2])
+    if batch and (record is None or batchLen >= batchsize):
+      if pool is None: texts = map(shuffleRecord, batch)
+      else: texts = pool.map(shuffleRecord, batch, 1 + len(batch) / (4 * procs))
+      out.write("".join(texts))
+      batch = []; batchLen = 0
+    if record is None: break
+  if pool is not None:
+    pool.close(); pool.join()
  
 def main():
 
@@ -148,6 +123,7 @@ def main():
 	file_name = None
 	seed = 1
 	copies = 1
+	procs = 1
 
 	#
 	# get command line arguments
@@ -159,8 +135,9 @@ def main():
         -t <tag>        added to shuffled sequence names
         -s <seed>	random seed; default: %d
 	-c <n>		make <n> shuffled copies of each sequence; default: %d
+	-p <n>		shuffle on <n> processes; the output is the same; default: %d
         -h              print this usage message
-	""" % (sys.argv[0], seed, copies)
+	""" % (sys.argv[0], seed, copies, procs)
 
         # no arguments: print usage
 	if len(sys.argv) == 1:
@@ -188,6 +165,10 @@ def main():
                         i += 1
                         try: copies = string.atoi(sys.argv[i])
                         except: print >> sys.stderr, usage; sys.exit(1)
+                elif (arg == "-p"):
+                        i += 1
+                        try: procs = string.atoi(sys.argv[i])
+                        except: print >> sys.stderr, usage; sys.exit(1)
                 elif (arg == "-h"):
                         print >> sys.stderr, usage; sys.exit(1)
                 else:
@@ -199,25 +180,11 @@ def main():
         if (file_name == None):
         	print >> sys.stderr, usage; sys.exit(1)
 
-	random.seed(seed)
-
-	# read sequences
-	seqs = sequence.readFASTA(file_name,'Extended DNA')
-
-	for s in seqs:
-		str = s.getString()
-		#FIXME altschul can't handle ambigs
-		name = s.getName()
-
-		#print >> sys.stderr, ">%s" % name
-
-		for i in range(copies):
-
-			shuffledSeq = dinuclShuffle(str)
+	# read sequences. The binary cache made by FastaCache.py is not used, since
+	# it has ambiguous letters converted to N and the shuffle keeps them
+	seqs = sequence.iterFASTA(file_name, None, True)
 
-			if (copies == 1):
-				print >> sys.stdout, ">%s\n%s" % (name+tag, shuffledSeq)
-			else:
-				print >> sys.stdout, ">%s_%d\n%s" % (name+tag, i, shuffledSeq)
+	records = ((index, name, s, seed, copies, tag) for index, (name, s) in enumerate(seqs))
+	shuffleRecords(records, procs, sys.stdout)
 	
 if __name__ == '__main__': main()
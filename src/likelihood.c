@@ -147,6 +147,59 @@ void calc_entropy (
 
 } /* calc_entropy */
 
+/**********************************************************************/
+/*
+	calc_motif_logev
+
+	Calculate the log E-value of a motif, the same as calc_entropy,
+	from the single-column LLR p-value table for its number of sites
+	(see llr_pv_table) and the sorted sequence lengths, instead of the
+	tables kept by get_llr_pv and get_log_nalign.  Only reads its
+	arguments, so it can be called from several threads at once.
+*/
+/**********************************************************************/
+double calc_motif_logev(
+  double *obs,					/* motif freqs, w x alength */
+  int w,					/* width of motif */
+  int N,					/* number of sites */
+  int alength,					/* length of alphabet */
+  double *back,					/* background model freqs */
+  double alpha,					/* scale factor of the table */
+  int offset,					/* offset of the table */
+  int range,					/* range of the table */
+  double *cdf,					/* (log) 1-CDF table */
+  MOTYPE mtype,					/* type of model */
+  BOOLEAN invcomp,				/* inv. compl. strand, too */
+  BOOLEAN pal,					/* motif is DNA palindrome */
+  int nseqs,					/* number of sequences */
+  int *len					/* sorted sequence lengths */
+)
+{
+  int i, j;
+  double log_pop = 0;				/* log product of col p-value */
+  double log_sig;				/* return value */
+
+  for (i=0; i<w; i++) {				/* position */
+    double rentropy = 0;			/* relative entropy of column */
+    double llr;					/* log likelihood ratio of column */
+    for (j=0; j<alength; j++) {			/* alphabet letter */
+      double f = obs[i*alength+j];		/* motif freq */
+      double p = back[j];			/* background freq */
+      rentropy += (f && p) ? f * LOG(f/p) : 0;
+    } /* alphabet letter */
+    llr = N * rentropy;				/* log likelihood ratio */
+    RND(llr, RNDDIG, llr);			/* round to RNDDIG places */
+    /* only one site p-value = 1.0, as in get_llr_pv */
+    if (N > 1) log_pop += llr_table_pv(llr, alpha, offset, range, cdf);
+  } /* position in motif */
+
+  /* compute the log E-value of the motif, as in get_log_sig */
+  log_sig = log_qfast(w, log_pop);
+  if (N) log_sig += get_log_nalign_len(mtype, w, N, invcomp && !pal, nseqs, len);
+
+  return log_sig;
+} /* calc_motif_logev */
+
 /**********************************************************************/
 /*
 	dq_test
@@ -244,10 +297,8 @@ double get_log_nalign(
   DATASET *dataset  				/* the dataset */
 )
 {
-  int i, t;
+  int i;
   int nseqs = dataset->n_samples;		/* number of sequences */
-  double log_nalign = 0;			/* log number alignments */
-  int icfactor = invcomp ? 2 : 1;		/* double the possible sites */
 
   /* 
     sort the sequence lengths in decreasing order in array len[] first time thru
@@ -258,6 +309,31 @@ double get_log_nalign(
     qsort((char *) len, nseqs, sizeof(int), int_compare);
   }
 
+  return get_log_nalign_len(mtype, w, N, invcomp, nseqs, len);
+} /* double get_log_nalign */
+
+/**********************************************************************/
+/*
+	get_log_nalign_len
+
+	Get an upper bound on the number of independent alignments
+	of segments of length w, given the sequence lengths sorted in
+	decreasing order.
+*/
+/**********************************************************************/
+double get_log_nalign_len(
+  MOTYPE mtype,					/* type of model */
+  int w,	 				/* width of motif */
+  int N,					/* number of occurrences */
+  BOOLEAN invcomp,				/* inv. compl. seq allowed */
+  int nseqs,					/* number of sequences */
+  int *len					/* sorted sequence lengths */
+)
+{
+  int i, t;
+  double log_nalign = 0;			/* log number alignments */
+  int icfactor = invcomp ? 2 : 1;		/* double the possible sites */
+
   /*
     get upper bound on number of alignments 
   */
@@ -282,7 +358,7 @@ double get_log_nalign(
   } /* mtype */
 
   return log_nalign;
-} /* double get_log_nalign */
+} /* double get_log_nalign_len */
 
 /**********************************************************************/
 /*
@@ -501,11 +501,8 @@ double get_llr_pv(
 )
 {
   int i, N;
-  double I;				/* weighted log likelihood ratio */
-  int I0, I1;				/* position of llr in table */
   double logpv;				/* log pvalue */
   double n0, n1;			/* floor and ceil of n */
-  double alpha;				/* scale factor used */
 
   if (n<=1) return 0.0;			/* only one site p-value = 1.0 */
 
@@ -572,23 +569,79 @@ double get_llr_pv(
     distrs[N].w = w; 				/* set maximum w */
   } /* new w */
   
-  /* get position in table */
-  alpha = distrs[N].alpha;
-  I = (alpha * llr) - distrs[N].offset[w];		/* position in table */
+  /* look up the position in table */
+  logpv = llr_table_pv(llr, distrs[N].alpha, distrs[N].offset[w],
+    distrs[N].range[w], distrs[N].cdf[w]);
+
+  /* return log p-value */
+  return logpv;
+} /* get_llr_pv */
+
+/******************************************************************************/
+/*
+	llr_pv_table
+
+	Compute the (log) 1-CDF table of the scaled LLR of a single column
+	with N sites, the same table that get_llr_pv uses for w=1, but
+	without storing it in the tables of get_llr_pv.  The caller owns
+	(and frees) the table, so tables for different backgrounds can be
+	kept at the same time.  Look up p-values with llr_table_pv.
+
+	Returns the table.
+*/
+/******************************************************************************/
+double *llr_pv_table(
+  int alength,				/* length of alphabet */
+  double *dd,				/* alphabet frequency distribution */
+  int N,				/* number of sites */
+  int range,				/* desired range for resolution */
+  double *alpha,			/* scale factor for scaled LLR */
+  int *offset,				/* table[0] = 1-cdf(offset) */
+  int *table_range			/* range of the table */
+)
+{
+  double *d, *c;
+
+  d = llr_distr(alength, dd, N, range, 1.0, alpha, offset, table_range);
+  c = cdf(d, *table_range);
+  myfree(d);
+
+  return c;
+} /* llr_pv_table */
+
+/******************************************************************************/
+/*
+	llr_table_pv
+
+	Look up the (log) p-value of a log likelihood ratio in a 1-CDF table
+	(see llr_pv_table), interpolating linearly between its entries.
+	Only reads the table, so it is safe to call from several threads.
+
+	Returns the log p-value.
+*/
+/******************************************************************************/
+double llr_table_pv(
+  double llr,				/* log likelihood ratio */
+  double alpha,				/* scale factor of the table */
+  int offset,				/* offset of the table */
+  int range,				/* range of the table */
+  double *cdf				/* (log) 1-CDF table */
+)
+{
+  double I;				/* weighted log likelihood ratio */
+  int I0, I1;				/* position of llr in table */
+
+  I = (alpha * llr) - offset;				/* position in table */
   I0 = (int) I;						/* floor of position */
   I1 = I0 + 1;						/* ceil. of position */
   if (I < 0) {						/* lower bound I */
-    logpv = distrs[N].cdf[w][0];
-  } else if (I0 >= distrs[N].range[w]) {		/* upper bound I */
-    logpv = distrs[N].cdf[w][distrs[N].range[w]];
+    return cdf[0];
+  } else if (I0 >= range) {				/* upper bound I */
+    return cdf[range];
   } else {						/* lin. interpolate */
-    logpv =
-      distrs[N].cdf[w][I0] + (I-I0)*(distrs[N].cdf[w][I1]-distrs[N].cdf[w][I0]);
+    return cdf[I0] + (I-I0)*(cdf[I1]-cdf[I0]);
   }
-
-  /* return log p-value */
-  return logpv;
-} /* get_llr_pv */
+} /* llr_table_pv */
 
 /******************************************************************************/
 /*
@@ -30,6 +30,24 @@ extern double get_llr_pv(
   double *dd 				/* alphabet frequency distribution */
 );
 
+extern double *llr_pv_table(
+  int alength,				/* length of alphabet */
+  double *dd,				/* alphabet frequency distribution */
+  int N,				/* number of sites */
+  int range,				/* desired range for resolution */
+  double *alpha,			/* scale factor for scaled LLR */
+  int *offset,				/* table[0] = 1-cdf(offset) */
+  int *table_range			/* range of the table */
+);
+
+extern double llr_table_pv(
+  double llr,				/* log likelihood ratio */
+  double alpha,				/* scale factor of the table */
+  int offset,				/* offset of the table */
+  int range,				/* range of the table */
+  double *cdf				/* (log) 1-CDF table */
+);
+
 extern double get_llr_mean(
   double n 				/* number sequences in alignment */
 );
@@ -430,6 +430,22 @@ extern void calc_entropy(
   MODEL *model,     /* the model */
   DATASET *dataset      /* the dataset */
 );
+extern double calc_motif_logev(
+  double *obs,          /* motif freqs, w x alength */
+  int w,          /* width of motif */
+  int N,          /* number of sites */
+  int alength,          /* length of alphabet */
+  double *back,          /* background model freqs */
+  double alpha,          /* scale factor of the table */
+  int offset,          /* offset of the table */
+  int range,          /* range of the table */
+  double *cdf,          /* (log) 1-CDF table */
+  MOTYPE mtype,          /* type of model */
+  BOOLEAN invcomp,        /* inv. compl. strand, too */
+  BOOLEAN pal,          /* motif is DNA palindrome */
+  int nseqs,          /* number of sequences */
+  int *len          /* sorted sequence lengths */
+);
 extern void dq_test( /*a test function*/
   MODEL *model,     /* the model */
   DATASET *dataset      /* the dataset */
@@ -445,6 +461,14 @@ extern double get_log_nalign(
   BOOLEAN invcomp,                              /* inv. compl. seq allowed */
   DATASET *dataset          /* the dataset */
 );
+extern double get_log_nalign_len(
+  MOTYPE mtype,          /* type of model */
+  int w,          /* width of motif */
+  int N,          /* number of occurrences */
+  BOOLEAN invcomp,                              /* inv. compl. seq allowed */
+  int nseqs,          /* number of sequences */
+  int *len          /* sorted sequence lengths */
+);
 extern void adjust_motif(
   MODEL *model,       /* the model */
   MODEL *scratch_model,     /* the scratch model */
@@ -1,9 +1,11 @@
 import numpy as np
 cimport numpy as np
-from libc.stdlib cimport malloc
+import threading
+from libc.stdlib cimport malloc, free
 
 cdef extern from "macros.h":
     ctypedef int BOOLEAN 
+    double EPSILON
 
 cdef extern from "mtype.h":
     cdef enum MOTYPE:
@@ -34,6 +36,13 @@ cdef extern from "meme.h":
 
     void calc_entropy(MODEL *model, DATASET *dataset)
     void dq_test(MODEL *model, DATASET *dataset)
+    double calc_motif_logev(double *obs, int w, int N, int alength, double *back, double alpha, int offset, int range, double *cdf, MOTYPE mtype, BOOLEAN invcomp, BOOLEAN pal, int nseqs, int *len) nogil
+
+cdef extern from "llr.h":
+    double *llr_pv_table(int alength, double *dd, int N, int range, double *alpha, int *offset, int *table_range)
+
+cdef extern from "user.h":
+    enum: LLR_RANGE
 
 cdef double** npy2d_double2d(np.ndarray[double, ndim=2, mode="c"] a):
     cdef double **tmp_c = <double**> malloc(a.shape[0] * sizeof(double*))
@@ -44,6 +53,7 @@ cdef double** npy2d_double2d(np.ndarray[double, ndim=2, mode="c"] a):
 cdef class MEME:
     cdef MODEL m
     cdef DATASET d
+    cdef SAMPLE *ss
     cdef pwm
     cdef background
     def __cinit__(self, np.ndarray[double, ndim=2, mode="c"] theta_motif, np.ndarray[double, ndim=1, mode="c"] theta_background, lambda_motif, sequences, int nsites_dis):
@@ -68,12 +78,16 @@ cdef class MEME:
         self.d.alphabet = "ACGT"
         self.d.n_samples = len(sequences)
         #do some malloc tricks to get an array of SAMPLE pointers
-        cdef SAMPLE* ss = <SAMPLE*> malloc(self.d.n_samples * sizeof(SAMPLE))
+        self.ss = <SAMPLE*> malloc(self.d.n_samples * sizeof(SAMPLE))
         self.d.samples = <SAMPLE**> malloc(self.d.n_samples * sizeof(SAMPLE*))
         for i in range(self.d.n_samples):
-            ss[i].length = len(sequences[i])
-            self.d.samples[i] = &ss[i]
-        x = 3
+            self.ss[i].length = len(sequences[i])
+            self.d.samples[i] = &self.ss[i]
+
+    def __dealloc__(self):
+        free(self.m.obs)
+        free(self.d.samples)
+        free(self.ss)
 
     def calc_ent(self):
         calc_entropy(&self.m, &self.d)
@@ -92,7 +106,165 @@ cdef class MEME:
         print self.m.ic
         print self.pwm
         print self.background
-        
 
-        
-        
+#LLR p-value tables of a single column, keyed by (number of sites, normalized background).
+#The E-value of a motif of any width W is computed from the table of one column, so one
+#table serves every W. They are shared by all engines
+_llr_tables = {}
+
+def normalize_background(background):
+    """ A copy of background that sums to 1 and has no 0's, computed the same way as
+    llr_distr does it in place. The copy is what the tables are keyed on and what the
+    E-values are computed with
+    """
+    cdef np.ndarray[double, ndim=1, mode="c"] back = np.array(background, dtype=np.double)
+    cdef double back_sum = 0
+    cdef int i
+    for i in range(len(back)):
+        back_sum += back[i] + EPSILON
+    for i in range(len(back)):
+        back[i] = (back[i] + EPSILON)/back_sum
+    return back
+
+def get_llr_table(int nsites, np.ndarray[double, ndim=1, mode="c"] background):
+    """ The LLR p-value table of a single column with nsites sites, as (alpha, offset,
+    range, 1-CDF). Made the first time it is asked for, then taken from the cache. The
+    background should come from normalize_background. It is never changed, since the
+    table is built from a copy of it
+    """
+    key = (nsites, background.tostring())
+    if key in _llr_tables:
+        return _llr_tables[key]
+    cdef double alpha = 0
+    cdef int offset = 0
+    cdef int table_range = 0
+    cdef double *table
+    cdef np.ndarray[double, ndim=1, mode="c"] cdf
+    cdef np.ndarray[double, ndim=1, mode="c"] dd
+    if nsites <= 1:#one site always has a p-value of 1, no table is needed
+        cdf = np.zeros(1)
+    else:
+        dd = background.copy()#llr_distr normalizes it in place
+        table = llr_pv_table(len(dd), &dd[0], nsites, LLR_RANGE, &alpha, &offset, &table_range)
+        cdf = np.empty(table_range+1)
+        for i in range(table_range+1):
+            cdf[i] = table[i]
+        free(table)
+    _llr_tables[key] = (alpha, offset, table_range, cdf)
+    return _llr_tables[key]
+
+cdef class EvalueEngine:
+    """ Computes MEME log E-values (as MEME.calc_ent does) of motifs in one dataset with one
+    background. The sorted sequence lengths are kept for the life of the engine and freed
+    with it, and the LLR p-value tables come from the cache of get_llr_table, so nothing is
+    recomputed from one motif to the next. The background is copied and normalized once,
+    and the array that is passed in is never changed.
+    """
+    cdef int nseqs
+    cdef int *len
+    cdef np.ndarray given_background
+    cdef np.ndarray background
+
+    def __cinit__(self, lengths, theta_background):
+        cdef np.ndarray[int, ndim=1, mode="c"] sorted_lengths = np.ascontiguousarray(np.sort(np.asarray(lengths, dtype=np.intc))[::-1])
+        self.nseqs = len(sorted_lengths)
+        self.len = <int*> malloc(max(1, self.nseqs) * sizeof(int))
+        if self.len == NULL:
+            raise MemoryError()
+        for i in range(self.nseqs):
+            self.len[i] = sorted_lengths[i]
+        self.given_background = np.array(theta_background, dtype=np.double)
+        self.background = normalize_background(self.given_background)
+
+    def __dealloc__(self):
+        free(self.len)
+
+    def get_background(self):
+        """ The background the engine was made with, before it was normalized
+        """
+        return self.given_background.copy()
+
+    def logev(self, theta_motif, int nsites_dis):
+        """ The log E-value of a motif with nsites_dis sites
+        """
+        cdef np.ndarray[double, ndim=2, mode="c"] pwm = np.ascontiguousarray(theta_motif, dtype=np.double)
+        cdef np.ndarray[double, ndim=1, mode="c"] back = self.background
+        if pwm.shape[1] != len(back):
+            raise ValueError("the motif and the background have different alphabets")
+        alpha, offset, table_range, table = get_llr_table(nsites_dis, back)
+        cdef np.ndarray[double, ndim=1, mode="c"] cdf = table
+        return calc_motif_logev(&pwm[0,0], pwm.shape[0], nsites_dis, len(back), &back[0], alpha, offset, table_range, &cdf[0], Tcm, 1, 0, self.nseqs, self.len)
+
+    def logevs(self, theta_motifs, nsites_dis, backgrounds=None, int threads=1):
+        """ The log E-values of many motifs at once, the same as logev for each. The motifs
+        can have different widths, and each can have its own background (one row of
+        backgrounds per motif) instead of the background of the engine. The tables are
+        looked up first, then all E-values are computed without holding the GIL, split over
+        threads threads, so other Python threads keep running (and several calls can run
+        in parallel).
+        """
+        cdef int n = len(theta_motifs)
+        if len(nsites_dis) != n:
+            raise ValueError("there must be one number of sites for each motif")
+        cdef int alength = len(self.background)
+        #each background is normalized, like the background of the engine
+        if backgrounds is None:
+            backs = [self.background]*n
+        else:
+            backs = [normalize_background(b) for b in backgrounds]
+        if len(backs) != n:
+            raise ValueError("there must be one background for each motif")
+        pwms = [np.ascontiguousarray(m, dtype=np.double) for m in theta_motifs]
+        for pwm, b in zip(pwms, backs):
+            if pwm.ndim != 2 or pwm.shape[1] != alength or b.shape != (alength,):
+                raise ValueError("the motifs and the background have different alphabets")
+        #all motifs in one buffer, and the table of each motif
+        cdef np.ndarray[double, ndim=1, mode="c"] obs = np.concatenate([pwm.ravel() for pwm in pwms] + [np.zeros(1)])
+        cdef np.ndarray[np.intp_t, ndim=1, mode="c"] starts = np.zeros(n, dtype=np.intp)
+        cdef np.ndarray[int, ndim=1, mode="c"] widths = np.array([len(pwm) for pwm in pwms], dtype=np.intc)
+        cdef np.ndarray[int, ndim=1, mode="c"] sites = np.array(nsites_dis, dtype=np.intc)
+        cdef np.ndarray[double, ndim=1, mode="c"] alphas = np.zeros(n)
+        cdef np.ndarray[int, ndim=1, mode="c"] offsets = np.zeros(n, dtype=np.intc)
+        cdef np.ndarray[int, ndim=1, mode="c"] ranges = np.zeros(n, dtype=np.intc)
+        cdef np.ndarray[double, ndim=1, mode="c"] logevs = np.zeros(n)
+        if n > 1:
+            starts[1:] = np.cumsum(widths[:-1])*alength
+        tables = [get_llr_table(sites[i], backs[i]) for i in range(n)]#keeps the tables alive
+        cdef np.ndarray[double, ndim=1, mode="c"] back = np.concatenate(backs + [np.zeros(1)])
+        cdef double **cdfs = <double**> malloc(max(1, n) * sizeof(double*))
+        if cdfs == NULL:
+            raise MemoryError()
+        cdef np.ndarray[double, ndim=1, mode="c"] cdf
+        for i in range(n):
+            alphas[i], offsets[i], ranges[i], cdf = tables[i]
+            cdfs[i] = &cdf[0]
+        cdef double *obs_ptr = &obs[0]
+        cdef np.intp_t *starts_ptr = &starts[0] if n > 0 else NULL
+        cdef int *widths_ptr = &widths[0] if n > 0 else NULL
+        cdef int *sites_ptr = &sites[0] if n > 0 else NULL
+        cdef double *alphas_ptr = &alphas[0] if n > 0 else NULL
+        cdef int *offsets_ptr = &offsets[0] if n > 0 else NULL
+        cdef int *ranges_ptr = &ranges[0] if n > 0 else NULL
+        cdef double *logevs_ptr = &logevs[0] if n > 0 else NULL
+        cdef double *back_ptr = &back[0]
+        cdef int nseqs = self.nseqs
+        cdef int *lens = self.len
+        def run(int lo, int hi):
+            cdef int k
+            with nogil:
+                for k in range(lo, hi):
+                    logevs_ptr[k] = calc_motif_logev(obs_ptr + starts_ptr[k], widths_ptr[k], sites_ptr[k], alength, back_ptr + k*alength, alphas_ptr[k], offsets_ptr[k], ranges_ptr[k], cdfs[k], Tcm, 1, 0, nseqs, lens)
+        try:
+            threads = max(1, min(threads, n))
+            if threads == 1:
+                run(0, n)
+            else:
+                bounds = [n*t//threads for t in range(threads+1)]
+                workers = [threading.Thread(target=run, args=(bounds[t], bounds[t+1])) for t in range(threads)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            free(cdfs)
+        return logevs
@@ -222,49 +222,73 @@ def readStrings(filename):
         txtlist.extend(line.split())
     return txtlist
 
-def readFASTA(filename, alpha = None, string_only = False):
-    """ Read one or more sequences from a file in FASTA format.
+def iterFASTA(filename, alpha = None, string_only = False, blocksize = 1 << 20):
+    """ Iterate over the sequences in a file in FASTA format, one at a time.
+    The file is read in blocks of blocksize bytes, and only the sequence that is being read is kept
+    in memory, so memory stays bounded by the longest sequence however large the file is.
     filename: name of file to load sequences from
     alpha: alphabet that is used (if left unspecified, an attempt is made to identify the alphabet for each individual sequence)
+    string_only: yield plain strings, which skips building Sequence objects and validating their alphabet
+    Yields (name, sequence) pairs.
     """
-    seqlist = []
     seqname = None
     seqinfo = None
     seqdata = []
     fh = open(filename)
-    thisline = fh.readline()
-    while (thisline):
-        if (thisline[0] == '>'): # new sequence
-            if (seqname):        # take care of the data that is already in the buffer before processing the new sequence
-                try:
-                    if (string_only):
-                        seqnew = ''.join(seqdata)
-                    else:
-                        seqnew = Sequence(seqdata, alpha, seqname, seqinfo)
-                    seqlist.append(seqnew)
-                except RuntimeError, e:
-                    print >> sys.stderr, "Warning: "+seqname+" is invalid (ignored): ", e
-            seqinfo = thisline[1:-1]         # everything on the defline is "info"
-            seqname = seqinfo.split()[0]     # up to first space
-            seqdata = []
-        else:  # pull out the sequence data
-            cleanline = thisline.split()
-            for line in cleanline:
-                seqdata.extend(tuple(line.strip('*'))) # sometimes a line ends with an asterisk in FASTA files
-        thisline = fh.readline()
-
+    rest = ''
+    while True:
+        block = fh.read(blocksize)
+        if block:
+            lines = (rest + block).split('\n')
+            rest = lines.pop()              # the last line may continue in the next block
+        else:
+            lines = [rest]
+        for thisline in lines:
+            if (thisline[:1] == '>'): # new sequence
+                if (seqname):        # take care of the data that is already in the buffer before processing the new sequence
+                    seqnew = _makeFASTASequence(seqdata, alpha, seqname, seqinfo, string_only)
+                    if seqnew is not None:
+                        yield seqname, seqnew
+                seqinfo = thisline[1:]           # everything on the defline is "info"
+                seqname = seqinfo.split()[0]     # up to first space
+                seqdata = []
+            else:  # pull out the sequence data
+                seqdata.append(thisline)
+        if not block:
+            break
+    fh.close()
     if (seqname):
-        try:
-            if (string_only):
-                seqnew = ''.join(seqdata)
-            else:
-                seqnew = Sequence(seqdata, alpha, seqname, seqinfo)
-            seqlist.append(seqnew)
-        except RuntimeError, e:
-            print >> sys.stderr, "Warning: " + seqname + " is invalid (ignored): ", e
+        seqnew = _makeFASTASequence(seqdata, alpha, seqname, seqinfo, string_only)
+        if seqnew is not None:
+            yield seqname, seqnew
     else:
         raise RuntimeError("No sequences on FASTA format found in this file")
-    fh.close()
+
+def _makeFASTASequence(seqdata, alpha, seqname, seqinfo, string_only):
+    """Join the lines of one FASTA record into a string (or a Sequence), or None if it is invalid"""
+    text = ''.join(''.join(seqdata).split())
+    if '*' in text: # sometimes a line ends with an asterisk in FASTA files
+        text = ''.join([word.strip('*') for line in seqdata for word in line.split()])
+    if (string_only):
+        return text
+    try:
+        return Sequence(text, alpha, seqname, seqinfo)
+    except RuntimeError, e:
+        print >> sys.stderr, "Warning: "+seqname+" is invalid (ignored): ", e
+        return None
+
+def readFASTA(filename, alpha = None, string_only = False, names = None):
+    """ Read one or more sequences from a file in FASTA format.
+    filename: name of file to load sequences from
+    alpha: alphabet that is used (if left unspecified, an attempt is made to identify the alphabet for each individual sequence)
+    names: if a list is given, the name of every sequence that is read is appended to it
+    Use iterFASTA instead to go through large files one sequence at a time.
+    """
+    seqlist = []
+    for seqname, seqnew in iterFASTA(filename, alpha, string_only):
+        seqlist.append(seqnew)
+        if names is not None:
+            names.append(seqname)
     return seqlist
 
 def _writeOneFASTA(sequence, filehandle):
@@ -717,6 +741,235 @@ def convert_ambigs(strings):
     return(strings)
 
 
+#------------------ PackedSequences -------------------
+
+from numpy import frombuffer, fromstring, zeros, uint8, cumsum, concatenate, bincount, nonzero, intp, newaxis, arange, load, save
+from numpy.lib.stride_tricks import as_strided
+
+# letter codes used by PackedSequences: A=0, C=1, G=2, T=3, everything else is N=4
+_N_CODE = 4
+_code_table = zeros(256, dtype=uint8) + _N_CODE
+for _i, _c in enumerate('ACGT'):
+    _code_table[ord(_c)] = _i
+    _code_table[ord(_c.lower())] = _i
+_code_table[ord('U')] = _code_table[ord('u')] = 3
+_code_letters = fromstring('ACGTN', dtype=uint8)
+
+class PackedSequences(object):
+    """A set of DNA sequences packed into one contiguous array of letter codes.
+    Sequence i occupies codes[offsets[i]:offsets[i+1]]. Letters are coded as
+    A=0, C=1, G=2, T=3 and any other (ambiguous or deleted) letter as N=4, so
+    memory is one byte per base pair. Windows of width W are exposed as strided
+    views into the code array, so no per-window objects are ever created.
+    names: the sequence names, if known
+    counts: the letter counts (see getLetterCounts), if already known
+    """
+    def __init__(self, strings = None, codes = None, offsets = None, names = None, counts = None):
+        """Pack a list of strings, or wrap already packed codes and offsets.
+        Example:
+        >>> packed = sequence.PackedSequences(['ACGTN', 'GGA'])
+        >>> packed.getString(1)
+        will output:
+        'GGA'
+        """
+        if strings is not None:
+            lens = [len(s) for s in strings]
+            self.offsets = concatenate(([0], cumsum(lens))).astype(intp)
+            self.codes = _code_table[frombuffer(''.join(strings), dtype=uint8)]
+        elif codes is not None and offsets is not None:
+            self.codes = codes
+            self.offsets = offsets
+        else:
+            raise RuntimeError("PackedSequences needs either strings or codes and offsets")
+        self.names = names
+        self.counts = counts
+
+    def __len__(self):
+        """Number of sequences"""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """The letter codes of sequence i (a view, not a copy)"""
+        return self.codes[self.offsets[i]:self.offsets[i+1]]
+
+    def getNumSeqs(self):
+        """Get the number of sequences"""
+        return len(self.offsets) - 1
+
+    def getLen(self):
+        """Get the total number of letters in all sequences"""
+        return len(self.codes)
+
+    def getSeqLens(self):
+        """Get the lengths of all sequences as an array"""
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def getString(self, i):
+        """Decode sequence i back into a string. Ambiguous letters come back as N"""
+        return _code_letters[self[i]].tostring()
+
+    def getStrings(self):
+        """Decode all sequences back into a list of strings"""
+        return [self.getString(i) for i in xrange(len(self))]
+
+    def getName(self, i):
+        """Get the name of sequence i. Sequences without known names are called sequence1, sequence2, ..."""
+        if self.names is None:
+            return "sequence" + str(i+1)
+        return self.names[i]
+
+    def getLetterCounts(self):
+        """Counts of A, C, G, T and N (in that order) over all sequences.
+        The counts are kept until the codes are changed with erase."""
+        if self.counts is None:
+            self.counts = bincount(self.codes, minlength=_N_CODE+1)
+        return self.counts
+
+    def erase(self, starts, W):
+        """Replace the W letters from each of the given start positions with N"""
+        self.codes[(starts[:,newaxis] + arange(W)).ravel()] = _N_CODE
+        self.counts = None
+
+    def windows(self, W):
+        """A read-only strided view of every length W window of the code array.
+        Row p is codes[p:p+W]. Rows that straddle two sequences are included,
+        use validStarts to know which rows are real subsequences.
+        """
+        n = max(0, len(self.codes) - W + 1)
+        s = self.codes.strides[0]
+        X = as_strided(self.codes, shape=(n, W), strides=(s, s))
+        X.flags.writeable = False
+        return X
+
+    def validStarts(self, W):
+        """Start positions (into the code array) of all length W windows that
+        lie within a single sequence and contain no N. Positions are returned in
+        ascending order, so they are grouped by sequence.
+        """
+        n = len(self.codes) - W + 1
+        if n <= 0:
+            return zeros(0, dtype=intp)
+        nbad = concatenate(([0], cumsum(self.codes == _N_CODE)))
+        valid = (nbad[W:] - nbad[:-W]) == 0
+        for end in self.offsets[1:-1]:#windows crossing a sequence boundary are not subsequences
+            valid[max(0, end-W+1):end] = False
+        return nonzero(valid)[0]
+
+    def toShared(self):
+        """Move the codes into shared memory, so that processes forked afterwards
+        (for example by multiprocessing.Pool) all read the same copy instead of
+        each holding their own. The shared codes are read-only.
+        """
+        from multiprocessing.sharedctypes import RawArray
+        raw = RawArray('B', max(1, len(self.codes)))
+        codes = frombuffer(raw, dtype=uint8)[:len(self.codes)]
+        codes[:] = self.codes
+        codes.flags.writeable = False
+        self.codes = codes
+        return self
+
+    def seqIndex(self, positions):
+        """Map positions in the code array to the index of the sequence holding them"""
+        return self.offsets.searchsorted(positions, side='right') - 1
+
+
+# Binary cache of a packed FASTA file. The cache is a folder next to the FASTA file holding the
+# codes, offsets, names and letter counts, plus the SHA-1 of the FASTA file it was made from.
+# A cache whose SHA-1 does not match the current FASTA file is ignored.
+
+def _cacheDir(filename):
+    return filename + ".cache"
+
+def _fileHash(filename):
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        block = fh.read(1 << 20)
+        while block:
+            h.update(block)
+            block = fh.read(1 << 20)
+    return h.hexdigest()
+
+def _packFASTA(filename):
+    """Read a FASTA file straight into PackedSequences, one sequence at a time.
+    Packing converts the ambiguous letters just like convert_ambigs does."""
+    names = []
+    chunks = []
+    lens = []
+    pending = []    # short sequences are packed together, a block at a time
+    npending = 0
+    for seqname, seq in iterFASTA(filename, None, True):
+        names.append(seqname)
+        lens.append(len(seq))
+        pending.append(seq)
+        npending += len(seq)
+        if npending >= 1 << 20:
+            chunks.append(_code_table[frombuffer(''.join(pending), dtype=uint8)])
+            pending = []
+            npending = 0
+    if pending:
+        chunks.append(_code_table[frombuffer(''.join(pending), dtype=uint8)])
+    offsets = concatenate(([0], cumsum(lens))).astype(intp)
+    codes = concatenate(chunks) if chunks else zeros(0, dtype=uint8)
+    return PackedSequences(codes = codes, offsets = offsets, names = names)
+
+def writePackedCache(filename):
+    """Read a FASTA file, convert ambiguous letters, pack it and write the binary cache
+    that readPackedFASTA and loadPackedCache use from then on.
+    Returns the PackedSequences."""
+    import os
+    key = _fileHash(filename)
+    packed = _packFASTA(filename)
+    names = packed.names
+    cachedir = _cacheDir(filename)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    keyfile = os.path.join(cachedir, "sha1")
+    if os.path.isfile(keyfile): # an interrupted rewrite must not look like a valid cache
+        os.remove(keyfile)
+    save(os.path.join(cachedir, "codes.npy"), packed.codes)
+    save(os.path.join(cachedir, "offsets.npy"), packed.offsets)
+    save(os.path.join(cachedir, "counts.npy"), packed.getLetterCounts())
+    with open(os.path.join(cachedir, "names.txt"), 'w') as fh:
+        for name in names:
+            fh.write(name + "\n")
+    with open(keyfile, 'w') as fh: # the key goes last
+        fh.write(key + "\n")
+    return packed
+
+def loadPackedCache(filename):
+    """Load the binary cache of a FASTA file, if there is one and it matches the file.
+    The codes are memory-mapped copy-on-write, so changing them (e.g. erasing motif sites)
+    never touches the cache. Returns a PackedSequences, or None if there is no valid cache."""
+    import os
+    cachedir = _cacheDir(filename)
+    keyfile = os.path.join(cachedir, "sha1")
+    if not os.path.isfile(keyfile):
+        return None
+    with open(keyfile) as fh:
+        key = fh.read().strip()
+    if key != _fileHash(filename):
+        print >> sys.stderr, "Warning: cache " + cachedir + " is out of date (ignored)"
+        return None
+    offsets = load(os.path.join(cachedir, "offsets.npy"))
+    if offsets[-1] > 0:
+        codes = load(os.path.join(cachedir, "codes.npy"), mmap_mode = 'c')
+    else: # an empty file can not be memory-mapped
+        codes = load(os.path.join(cachedir, "codes.npy"))
+    counts = load(os.path.join(cachedir, "counts.npy"))
+    with open(os.path.join(cachedir, "names.txt")) as fh:
+        names = [line.rstrip("\n") for line in fh]
+    return PackedSequences(codes = codes, offsets = offsets, names = names, counts = counts)
+
+def readPackedFASTA(filename):
+    """Read a FASTA file as PackedSequences, with ambiguous letters converted to N.
+    Uses the binary cache (see writePackedCache) if there is a valid one."""
+    packed = loadPackedCache(filename)
+    if packed is None:
+        packed = _packFASTA(filename)
+    return packed
+
+
 #------------------ Main method -------------------
 # Executed if you run this file from the operating system prompt, e.g.
 # > python sequence.py